@@ -0,0 +1,397 @@
+"""
+Headless batch runner of flight design and quality control.
+
+Usage (from the directory containing the plugin folder):
+
+    python -m flight_planner.batch jobs.json --processes 4
+
+The job file holds a list of jobs (or {"jobs": [...]}), every job is
+a dictionary. Keys common for all jobs:
+    type        'design' or 'control'
+    name        name of the job, default 'job_<index>'
+    camera      camera name from cameras.json
+    output      output directory
+
+Block design ('design'):
+    aoi         vector layer with Area of Interest polygon
+    gsd         ground sampling distance [cm] or
+    altitude_agl  flight altitude above ground [m]
+    overlap, sidelap    [%], default 60 and 30
+    increase_overlap    increase overlaps for terrain height differences
+    direction   flight direction [deg], default 0
+    multiple_base, exceed   default 2 and 25 (as in the dialog)
+    min_height, max_height  terrain heights, taken from 'dtm' if not given
+    dtm         DTM raster (optional)
+    altitude    'one' (default) or 'terrain_following' (needs 'dtm')
+Outputs: projection_centres.gpkg, photos.gpkg.
+
+Quality control ('control'):
+    eo          vector layer of projection centres
+    fields      names of height, omega, phi, kappa fields, default
+                the fields written by design
+    height_is_asl   default true
+    dtm         DTM raster
+    threshold   iteration threshold [m], default 0.1
+    edge_tolerance  adaptive sampling of photo edges [m], default 0
+    outputs     any of 'footprint', 'overlap', 'gsd', default all
+    backend     kernels backend 'auto' (default), 'numpy' or 'numba'
+    mosaic_memory   [MB] overlapping and GSD grids larger than this
+                are kept in files in the output directory, default 2048
+Outputs: footprint.gpkg, overlay.tif, gsd.tif.
+
+Jobs run concurrently in a bounded pool of processes. QGIS application
+is started only in processes running design jobs, control jobs use GDAL
+and OGR only.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from math import fabs
+
+import numpy as np
+from osgeo import gdal, gdal_array, ogr, osr
+
+from .camera import FILE_PATH as CAMERAS_PATH, Camera
+from .dtm import DTMTileCache, sample_heights
+from .functions import (
+    get_transformer,
+    photos_control,
+    photos_windows,
+    polygon_wkb,
+    transf_coord
+)
+from .kernels import get_backend, set_backend
+from .mosaic import MosaicAccumulator
+from .parallel import python_executable
+
+DESIGN_FIELDS = {'height': 'Alt. ASL [m]', 'omega': 'Omega [deg]',
+                 'phi': 'Phi [deg]', 'kappa': 'Kappa [deg]'}
+
+# number of photos computed at once in control jobs
+CHUNK_SIZE = 64
+
+# QGIS application of the process, started by the first design job
+_qgis_app = None
+
+
+def load_camera(name):
+    """Return Camera of given name from cameras.json."""
+    with open(CAMERAS_PATH, 'r') as cameras_file:
+        for camera in json.load(cameras_file):
+            if camera['name'] == name:
+                return Camera(**camera)
+    raise ValueError(f'Camera {name!r} not found in cameras.json')
+
+
+def srs_id(srs):
+    """Return 'AUTHORITY:CODE' of spatial reference or its WKT
+    if it has no authority code."""
+    srs = srs.Clone()
+    srs.AutoIdentifyEPSG()
+    name, code = srs.GetAuthorityName(None), srs.GetAuthorityCode(None)
+    if name and code:
+        return f'{name}:{code}'
+    return srs.ExportToWkt()
+
+
+def qgis_application():
+    """Start QGIS application without GUI (once per process)."""
+    global _qgis_app
+    if _qgis_app is None:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from qgis.core import QgsApplication
+        QgsApplication.setPrefixPath(
+            os.environ.get('QGIS_PREFIX_PATH', '/usr'), True)
+        _qgis_app = QgsApplication([], False)
+        _qgis_app.initQgis()
+    return _qgis_app
+
+
+def create_raster(path, array, geotransform, projection, nodata):
+    """Create one band tiled GeoTIFF with size and data type of array,
+    return the dataset, its band is written by the caller."""
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, xsize=array.shape[1], ysize=array.shape[0],
+                       bands=1,
+                       eType=gdal_array.NumericTypeCodeToGDALTypeCode(
+                           array.dtype),
+                       options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    ds.GetRasterBand(1).SetNoDataValue(nodata)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
+    return ds
+
+
+def read_eo(path, fields):
+    """Return array of Exterior Orientation parameters
+    (X, Y, Z, omega, phi, kappa) and spatial reference of vector layer."""
+    source = ogr.Open(path)
+    if source is None:
+        raise IOError(f'Can not open {path}')
+    layer = source.GetLayer(0)
+    eo = []
+    for feature in layer:
+        point = feature.GetGeometryRef()
+        eo.append([point.GetX(), point.GetY(),
+                   feature.GetField(fields['height']),
+                   feature.GetField(fields['omega']),
+                   feature.GetField(fields['phi']),
+                   feature.GetField(fields['kappa'])])
+    srs = layer.GetSpatialRef().Clone()
+    return np.array(eo, dtype=float).reshape((-1, 6)), srs
+
+
+def save_footprints(path, footprints, srs):
+    """Save list of footprint vertices arrays as polygon GeoPackage."""
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    source = driver.CreateDataSource(path)
+    layer = source.CreateLayer('footprint', srs, ogr.wkbPolygon)
+    layer.StartTransaction()
+    for vertices in footprints:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(polygon_wkb(vertices)))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    source = None
+
+
+def run_control_job(job):
+    """Quality control of a flight, see module docstring."""
+    camera = load_camera(job['camera'])
+    outputs = job.get('outputs', ['footprint', 'overlap', 'gsd'])
+    fields = dict(DESIGN_FIELDS, **job.get('fields', {}))
+    threshold = job.get('threshold', 0.1)
+    edge_tolerance = job.get('edge_tolerance', 0) or None
+    set_backend(job.get('backend', 'auto'))
+    raster_outputs = 'overlap' in outputs or 'gsd' in outputs
+
+    raster = gdal.Open(job['dtm'])
+    if raster is None:
+        raise IOError(f"Can not open {job['dtm']}")
+    srs_rst = osr.SpatialReference(wkt=raster.GetProjection())
+    eo, srs_vct = read_eo(job['eo'], fields)
+    crs_rst, crs_vct = srs_id(srs_rst), srs_id(srs_vct)
+    transf_vct_rst = get_transformer(crs_vct, crs_rst)
+    transf_rst_vct = get_transformer(crs_rst, crs_vct)
+
+    dtm = DTMTileCache(raster)
+    Z_min, _ = dtm.minmax()
+    if not job.get('height_is_asl', True):
+        eo[:, 2] += sample_heights(dtm, eo[:, 0], eo[:, 1], transf_vct_rst)
+
+    uplx_r, xres_r, _, uply_r, _, yres_r = dtm.geotransform
+    # calculating metric resolution if crs is geographic
+    if srs_rst.IsGeographic():
+        x_v, y_v = transf_coord(transf_rst_vct, [uplx_r, uplx_r + xres_r],
+                                [uply_r, uply_r + yres_r])
+        xres_r = fabs(x_v[1] - x_v[0])
+        yres_r = fabs(y_v[1] - y_v[0])
+    mean_res = (fabs(xres_r) + fabs(yres_r)) / 2
+
+    xyf_corners = camera.image_corners()
+    windows = photos_windows(dtm, xyf_corners, eo, Z_min, transf_vct_rst,
+                             crs_rst, crs_vct)
+    mosaic = MosaicAccumulator(dtm.geotransform, windows,
+                               job.get('mosaic_memory', 2048) * 1024**2,
+                               job['output'])
+    footprints = []
+    for start in range(0, eo.shape[0], CHUNK_SIZE):
+        for vertices, gsd_masked, overlap_arr, overlap_geot in photos_control(
+                dtm, camera, xyf_corners, eo[start:start + CHUNK_SIZE], Z_min,
+                mean_res, threshold, crs_rst, crs_vct, transf_vct_rst,
+                raster_outputs, edge_tolerance):
+            footprints.append(vertices)
+            if raster_outputs:
+                mosaic.add(gsd_masked, overlap_arr, overlap_geot)
+
+    written = []
+    if 'footprint' in outputs:
+        path = os.path.join(job['output'], 'footprint.gpkg')
+        save_footprints(path, footprints, srs_vct)
+        written.append(path)
+    if raster_outputs and mosaic.covered is not None:
+        geo, final_overlay, final_gsd = mosaic.trimmed()
+        ds_overlay = ds_gsd = None
+        if 'overlap' in outputs:
+            path = os.path.join(job['output'], 'overlay.tif')
+            ds_overlay = create_raster(path, final_overlay, geo,
+                                       raster.GetProjection(), 0)
+            written.append(path)
+        if 'gsd' in outputs:
+            path = os.path.join(job['output'], 'gsd.tif')
+            ds_gsd = create_raster(path, final_gsd, geo,
+                                   raster.GetProjection(), 1000)
+            written.append(path)
+        mosaic.write(None if ds_overlay is None else ds_overlay.GetRasterBand(1),
+                     None if ds_gsd is None else ds_gsd.GetRasterBand(1))
+        ds_overlay = ds_gsd = None
+    mosaic.close()
+    return written
+
+
+def run_design_job(job):
+    """Block flight design, see module docstring."""
+    qgis_application()
+    from qgis.core import (
+        QgsCoordinateTransformContext,
+        QgsVectorFileWriter,
+        QgsVectorLayer
+    )
+    from .functions import bounding_box_at_angle, minmaxheight, \
+        projection_centres
+
+    camera = load_camera(job['camera'])
+    aoi = QgsVectorLayer(job['aoi'], 'aoi', 'ogr')
+    if not aoi.isValid():
+        raise IOError(f"Can not open {job['aoi']}")
+    crs_vct = aoi.sourceCrs().authid()
+    for feature in aoi.getFeatures():
+        geom_AoI = feature.geometry()
+
+    if 'min_height' in job and 'max_height' in job:
+        min_h, max_h = job['min_height'], job['max_height']
+    else:
+        raster = gdal.Open(job['dtm'])
+        crs_rst = srs_id(osr.SpatialReference(wkt=raster.GetProjection()))
+        min_h, max_h = minmaxheight(aoi, DTMTileCache(raster),
+                                    get_transformer(crs_vct, crs_rst))
+
+    if 'gsd' in job:
+        gsd = job['gsd'] / 100
+        altitude_AGL = gsd / camera.sensor_size * camera.focal_length
+    else:
+        altitude_AGL = job['altitude_agl']
+        gsd = altitude_AGL * camera.sensor_size / camera.focal_length
+    altitude_ASL = (max_h + min_h) / 2 + altitude_AGL
+
+    p = job.get('overlap', 60) / 100
+    q = job.get('sidelap', 30) / 100
+    if job.get('increase_overlap', False):
+        p += 0.5 * ((max_h - min_h) / 2) / altitude_AGL
+        q += 0.7 * ((max_h - min_h) / 2) / altitude_AGL
+    # image length along and across flight direction[m]
+    len_along = camera.pixels_along_track * gsd
+    len_across = camera.pixels_across_track * gsd
+    # longitudinal base Bx, transverse base By
+    Bx = len_along * (1 - p)
+    By = len_across * (1 - q)
+
+    angle = 90 - job.get('direction', 0)
+    if angle < 0:
+        angle = angle + 360
+    a, b, a2, b2, Dx, Dy = bounding_box_at_angle(angle, geom_AoI)
+    pc_lay, photo_lay, _, _ = projection_centres(
+        angle, geom_AoI, crs_vct, a, b, a2, b2, Dx, Dy, Bx, By, len_along,
+        len_across, job.get('exceed', 25), job.get('multiple_base', 2),
+        altitude_ASL, 0, 0)
+
+    if job.get('dtm'):
+        raster = gdal.Open(job['dtm'])
+        crs_rst = srs_id(osr.SpatialReference(wkt=raster.GetProjection()))
+        feats = list(pc_lay.getFeatures())
+        terrain_heights = sample_heights(
+            DTMTileCache(raster),
+            [f.geometry().asPoint().x() for f in feats],
+            [f.geometry().asPoint().y() for f in feats],
+            get_transformer(crs_vct, crs_rst))
+        changes = {}
+        for f, terrain_height in zip(feats, terrain_heights):
+            if job.get('altitude', 'one') == 'terrain_following':
+                changes[f.id()] = {4: round(altitude_AGL + terrain_height, 2),
+                                   5: round(altitude_AGL, 2)}
+            else:
+                changes[f.id()] = {5: round(altitude_ASL - terrain_height, 2)}
+        pc_lay.dataProvider().changeAttributeValues(changes)
+
+    written = []
+    for layer, name in ((pc_lay, 'projection_centres'), (photo_lay, 'photos')):
+        path = os.path.join(job['output'], name + '.gpkg')
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        error = QgsVectorFileWriter.writeAsVectorFormatV2(
+            layer, path, QgsCoordinateTransformContext(), options)
+        if error[0] != QgsVectorFileWriter.NoError:
+            raise IOError(f'Can not write {path}: {error[1]}')
+        written.append(path)
+    return written
+
+
+def run_job(job):
+    """Run one job, return dictionary with its status."""
+    start = time.time()
+    report = {'name': job['name'], 'type': job.get('type')}
+    try:
+        os.makedirs(job['output'], exist_ok=True)
+        if job.get('type') == 'design':
+            report['outputs'] = run_design_job(job)
+        elif job.get('type') == 'control':
+            report['outputs'] = run_control_job(job)
+            report['backend'] = get_backend()
+        else:
+            raise ValueError(f"Unknown job type {job.get('type')!r}")
+        report['status'] = 'done'
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = f'{e}\n{traceback.format_exc()}'
+    report['seconds'] = round(time.time() - start, 3)
+    return report
+
+
+def load_jobs(path):
+    """Return list of jobs from job file, relative paths are resolved
+    against directory of the file."""
+    with open(path, 'r') as jobs_file:
+        jobs = json.load(jobs_file)
+    if isinstance(jobs, dict):
+        jobs = jobs['jobs']
+    base = os.path.dirname(os.path.abspath(path))
+    for i, job in enumerate(jobs):
+        job.setdefault('name', f'job_{i + 1}')
+        job.setdefault('output', job['name'])
+        for key in ('aoi', 'eo', 'dtm', 'output'):
+            if job.get(key):
+                job[key] = os.path.join(base, job[key])
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m flight_planner.batch',
+        description='Run flight design and quality control jobs '
+                    'without QGIS GUI.')
+    parser.add_argument('jobs', help='JSON file with list of jobs')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=os.cpu_count() or 1,
+                        help='number of jobs running at once')
+    parser.add_argument('-r', '--report',
+                        help='save JSON report of all jobs to this file')
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.jobs)
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python_executable())
+    reports = []
+    with ProcessPoolExecutor(max_workers=max(args.processes, 1),
+                             mp_context=context) as executor:
+        for report in executor.map(run_job, jobs):
+            reports.append(report)
+            print(f"{report['name']}: {report['status']} "
+                  f"({report['seconds']} s)")
+            if report['status'] == 'failed':
+                print(report['error'], file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(reports, report_file, indent=4)
+    return 0 if all(r['status'] == 'done' for r in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
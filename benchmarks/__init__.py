@@ -0,0 +1,5 @@
+"""
+Performance benchmarks of the plugin, run with:
+
+    python -m flight_planner.benchmarks.run --help
+"""
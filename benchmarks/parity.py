@@ -0,0 +1,79 @@
+"""
+Parity of kernels of the Numba backend (see kernels.py) with the NumPy
+reference implementation on synthetic data. Ground edge points, footprint
+masks and GSD arrays of the sample photos are computed with both backends
+and compared, the exit status is 1 if any difference exceeds its
+tolerance.
+
+    python -m flight_planner.benchmarks.parity --dtm fractal --tilt 3
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+from ..kernels import available_backends, set_backend
+from .run import Scene, check_scene_arguments, scene_arguments
+
+
+def compare_edges(numpy_edges, numba_edges, threshold):
+    """Return maximum distance between edge points, rays stop within
+    threshold of the terrain intersection, so the tolerance is threshold."""
+    diff = max(np.abs(a - b).max() for a, b in zip(numpy_edges, numba_edges))
+    return diff, diff <= threshold
+
+
+def compare_masks(numpy_masks, numba_masks):
+    """Return number of different pixels of footprint masks and
+    geotransforms, masks are computed from the same vertices and must
+    be identical."""
+    diff = 0
+    for (mask_a, geot_a), (mask_b, geot_b) in zip(numpy_masks, numba_masks):
+        if mask_a.shape != mask_b.shape or list(geot_a) != list(geot_b):
+            diff += max(mask_a.size, mask_b.size)
+        else:
+            diff += int(np.count_nonzero(mask_a != mask_b))
+    return diff, diff == 0
+
+
+def compare_gsds(numpy_gsds, numba_gsds):
+    """Return maximum relative difference of GSD arrays, allowing float32
+    rounding."""
+    diff = max(float(np.max(np.abs(a - b) / np.abs(a)))
+               for a, b in zip(numpy_gsds, numba_gsds))
+    return diff, diff <= 1e-5
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m flight_planner.benchmarks.parity',
+                                     description=__doc__.split('\n\n')[0])
+    scene_arguments(parser)
+    args = parser.parse_args(argv)
+    check_scene_arguments(parser, args)
+    if 'numba' not in available_backends():
+        print('Numba is not installed, nothing to compare')
+        return 0
+
+    set_backend('numpy')
+    scene = Scene(args)
+    results = {}
+    for backend in ('numpy', 'numba'):
+        set_backend(backend)
+        results[backend] = (scene.edges(), scene.overlaps(), scene.gsds())
+    set_backend('auto')
+    scene.close()
+
+    checks = [('ground_edge_points', compare_edges(results['numpy'][0],
+                                                   results['numba'][0],
+                                                   args.threshold)),
+              ('overlap_photo', compare_masks(results['numpy'][1],
+                                              results['numba'][1])),
+              ('gsd', compare_gsds(results['numpy'][2], results['numba'][2]))]
+    for name, (diff, ok) in checks:
+        print(f"{name:20s} max difference {diff:12.6g}  {'OK' if ok else 'FAIL'}")
+    return 0 if all(ok for _, (_, ok) in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
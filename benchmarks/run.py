@@ -0,0 +1,349 @@
+"""
+Benchmarks of the main steps of flight design and quality control
+on synthetic data. Every case is timed 'repeat' times (the best and mean
+time are reported), peak memory of Python allocations is measured in one
+extra run with tracemalloc. Results are saved as JSON, a previous result
+file given with --compare is used to print speedups.
+
+    python -m flight_planner.benchmarks.run --dtm fractal --size 4000 \
+        --photos 1000 --output bench.json
+
+DTM is held in memory (ArrayDTM), with --dtm-file it is written
+to a temporary GeoTIFF and read through DTMTileCache like in control
+runs, so tile reads, decoding and eviction are measured too. Counters
+of DTM reads of every case are saved with its results.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from pyproj import CRS
+
+from ..camera import Camera
+from ..dtm import ArrayDTM, DTMTileCache
+from ..functions import (
+    clip_raster,
+    get_transformer,
+    gsd,
+    ground_edge_points,
+    image_edge_points,
+    overlap_photo,
+    photos_control,
+    photos_windows,
+    rotation_matrix,
+    transf_coord,
+    zonal_statistics
+)
+from ..kernels import available_backends, set_backend
+from ..mosaic import MosaicAccumulator
+from .synthetic import eo_block, synthetic_dtm, write_geotiff
+
+CAMERA = Camera('benchmark', 0.05, 4e-06, 6000, 4000)
+
+
+def measure(func, repeat):
+    """Return best and mean time of 'repeat' calls of func and peak
+    memory [B] of one more call."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak
+
+
+def metric_resolution(geotransform, crs_rst, crs_vct):
+    """Return mean DTM resolution in metres, resolution of DTM in geographic
+    CRS is measured in (projected) CRS of EO, as in control runs."""
+    uplx, xres, _, uply, _, yres = geotransform
+    if CRS(crs_rst).is_geographic:
+        x, y = transf_coord(get_transformer(crs_rst, crs_vct),
+                            [uplx, uplx + xres], [uply, uply + yres])
+        xres, yres = x[1] - x[0], y[1] - y[0]
+    return (abs(xres) + abs(yres)) / 2
+
+
+class Scene():
+    """Synthetic DTM, EO block and inputs of single photo functions."""
+
+    def __init__(self, args):
+        array, geotransform = synthetic_dtm(args.dtm, args.size, args.res,
+                                            (args.x0, args.y0),
+                                            seed=args.seed)
+        self.directory = None
+        if getattr(args, 'dtm_file', False):
+            self.directory = tempfile.mkdtemp(prefix='benchmark_')
+            dataset = write_geotiff(os.path.join(self.directory, 'dtm.tif'),
+                                    array, geotransform, args.crs)
+            self.dtm = DTMTileCache(dataset, args.tile_size,
+                                    args.cache_size * 1024**2)
+        else:
+            self.dtm = ArrayDTM(array, geotransform)
+        self.crs_rst = args.crs
+        self.crs_vct = args.eo_crs or args.crs
+        self.transf_vct_rst = get_transformer(self.crs_vct, self.crs_rst)
+        self.eo = eo_block(args.photos, array, geotransform, args.altitude,
+                           args.tilt, args.seed, self.crs_rst, self.crs_vct)
+        self.Z_min = float(array.min())
+        self.mean_res = metric_resolution(geotransform, self.crs_rst,
+                                          self.crs_vct)
+        self.threshold = args.threshold
+        self.xyf_corners = CAMERA.image_corners()
+        self.sample = self.eo[:args.sample]
+        self.R = [rotation_matrix(*row[3:]) for row in self.sample]
+        self.prepare()
+
+    def close(self):
+        """Remove temporary GeoTIFF of DTM."""
+        if self.directory is not None:
+            self.dtm = None
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def clip(self):
+        return [clip_raster(self.dtm, self.xyf_corners, R, *row[:3],
+                            self.Z_min, self.transf_vct_rst, self.crs_rst,
+                            self.crs_vct)
+                for R, row in zip(self.R, self.sample)]
+
+    def prepare(self):
+        """Intermediate results used as inputs of the next steps."""
+        self.clipped = self.clip()
+        self.Z_under_pc = []
+        self.xyf = []
+        for (clipped_DTM, geot), row in zip(self.clipped, self.sample):
+            X, Y = transf_coord(self.transf_vct_rst, row[0], row[1])
+            c = int((X - geot[0]) / geot[1])
+            r = int((Y - geot[3]) / geot[5])
+            r = min(max(r, 0), clipped_DTM.shape[0] - 1)
+            c = min(max(c, 0), clipped_DTM.shape[1] - 1)
+            self.Z_under_pc.append(float(clipped_DTM[r, c]))
+            self.xyf.append(image_edge_points(CAMERA, self.Z_under_pc[-1],
+                                              row[2], self.mean_res))
+        self.footprints = self.edges()
+
+    def edges(self):
+        return [ground_edge_points(R, Z, self.threshold, xyf, *row[:3],
+                                   clipped_DTM, geot, self.crs_rst,
+                                   self.crs_vct, self.transf_vct_rst)
+                for R, Z, xyf, row, (clipped_DTM, geot)
+                in zip(self.R, self.Z_under_pc, self.xyf, self.sample,
+                       self.clipped)]
+
+    def vertices_rast(self, vertices):
+        X, Y = transf_coord(self.transf_vct_rst, vertices[:, 0],
+                            vertices[:, 1])
+        return np.column_stack((X, Y))
+
+    def overlaps(self):
+        return [overlap_photo(self.vertices_rast(vertices), geot,
+                              clipped_DTM.shape)
+                for vertices, (clipped_DTM, geot)
+                in zip(self.footprints, self.clipped)]
+
+    def gsds(self):
+        return [gsd(clipped_DTM, geot, *row[:3], R, CAMERA.focal_length,
+                    CAMERA.sensor_size)
+                for R, row, (clipped_DTM, geot)
+                in zip(self.R, self.sample, self.clipped)]
+
+    def zonal(self):
+        """Minimum and maximum height within footprints of the sample."""
+        return zonal_statistics(self.dtm,
+                                [[[vertices]] for vertices in self.footprints],
+                                self.transf_vct_rst)
+
+    def control(self, chunk_size=64):
+        """Full control pass: footprints, overlapping and GSD mosaic."""
+        windows = photos_windows(self.dtm, self.xyf_corners, self.eo,
+                                 self.Z_min, self.transf_vct_rst,
+                                 self.crs_rst, self.crs_vct)
+        mosaic = MosaicAccumulator(self.dtm.geotransform, windows)
+        for start in range(0, self.eo.shape[0], chunk_size):
+            for _, gsd_masked, overlap_arr, overlap_geot in photos_control(
+                    self.dtm, CAMERA, self.xyf_corners,
+                    self.eo[start:start + chunk_size], self.Z_min,
+                    self.mean_res, self.threshold, self.crs_rst,
+                    self.crs_vct, self.transf_vct_rst):
+                mosaic.add(gsd_masked, overlap_arr, overlap_geot)
+        return mosaic
+
+
+def design_cases(scene, args):
+    """Cases of flight design, they need QGIS application."""
+    from ..batch import qgis_application
+    qgis_application()
+    from qgis.core import QgsGeometry, QgsRectangle
+    from ..functions import bounding_box_at_angle, projection_centres
+
+    geot = scene.dtm.geotransform
+    rows, cols = scene.dtm.shape
+    aoi = QgsGeometry.fromRect(QgsRectangle(geot[0], geot[3] + rows * geot[5],
+                                            geot[0] + cols * geot[1], geot[3]))
+    # GSD chosen to get about the requested number of photos
+    area = aoi.area()
+    gsd_design = (area / (args.photos * 0.4 * 0.7 * CAMERA.pixels_along_track
+                          * CAMERA.pixels_across_track)) ** 0.5
+    len_along = CAMERA.pixels_along_track * gsd_design
+    len_across = CAMERA.pixels_across_track * gsd_design
+    Bx, By = len_along * 0.4, len_across * 0.7
+    angle = 90
+    box = bounding_box_at_angle(angle, aoi)
+
+    def design():
+        return projection_centres(angle, aoi, scene.crs_rst, *box, Bx, By,
+                                  len_along, len_across, 25, 2, 1000, 0, 0)
+
+    count = design()[0].featureCount()
+    return [('projection_centres', design, count)]
+
+
+def run(args):
+    scene = Scene(args)
+    n_sample = len(scene.sample)
+    cases = [('clip_raster', scene.clip, n_sample),
+             ('ground_edge_points', scene.edges, n_sample),
+             ('overlap_photo', scene.overlaps, n_sample),
+             ('gsd', scene.gsds, n_sample),
+             ('zonal_statistics', scene.zonal, n_sample),
+             ('control', scene.control, scene.eo.shape[0])]
+    if args.design:
+        cases += design_cases(scene, args)
+
+    results = []
+    for name, func, items in cases:
+        if args.only and name not in args.only:
+            continue
+        # every case starts with empty tile cache
+        if hasattr(scene.dtm, 'clear'):
+            scene.dtm.clear()
+        before = scene.dtm.stats()
+        best, mean, peak = measure(func, args.repeat)
+        after = scene.dtm.stats()
+        dtm_stats = {key: after[key] - before[key]
+                     for key in ('hits', 'misses', 'bytes_read')}
+        dtm_stats.update(cached_tiles=after['cached_tiles'],
+                         cached_bytes=after['cached_bytes'])
+        results.append({'name': name,
+                        'items': items,
+                        'best_s': best,
+                        'mean_s': mean,
+                        'items_per_s': items / best if best else None,
+                        'peak_mb': peak / 1024**2,
+                        'dtm_cache': dtm_stats})
+        print(f'{name:20s} {items:8d} items  best {best:9.4f} s  '
+              f'mean {mean:9.4f} s  {items / best if best else 0:10.1f} /s  '
+              f'peak {peak / 1024**2:8.1f} MB  '
+              f"tile misses {dtm_stats['misses']}")
+    scene.close()
+    return results
+
+
+def compare(results, path):
+    """Print speedup (ratio of throughputs) of results against results
+    saved in path."""
+    with open(path, 'r') as old_file:
+        old = {r['name']: r for r in json.load(old_file)['results']}
+    for r in results:
+        if old.get(r['name'], {}).get('items_per_s') and r['items_per_s']:
+            print(f"{r['name']:20s} speedup "
+                  f"{r['items_per_s'] / old[r['name']]['items_per_s']:6.2f}x")
+
+
+def projected_crs(crs):
+    """Argument type of CRS of EO, which must be projected (metres)."""
+    try:
+        geographic = CRS(crs).is_geographic
+    except Exception:
+        raise argparse.ArgumentTypeError(f'unknown CRS {crs}')
+    if geographic:
+        raise argparse.ArgumentTypeError(
+            f'{crs} is geographic, CRS of EO must be projected')
+    return crs
+
+
+def check_scene_arguments(parser, args):
+    """Exit with error if EO would be in geographic CRS: the default CRS
+    of EO is the CRS of DTM."""
+    if args.eo_crs is None and CRS(args.crs).is_geographic:
+        parser.error(f'--crs {args.crs} is geographic, give projected CRS '
+                     f'of EO with --eo-crs')
+
+
+def scene_arguments(parser):
+    """Add arguments of Scene to parser."""
+    parser.add_argument('--dtm', choices=['flat', 'sloped', 'fractal'],
+                        default='fractal')
+    parser.add_argument('--size', type=int, default=2000,
+                        help='DTM size [pixels]')
+    parser.add_argument('--res', type=float, default=1.0,
+                        help='DTM resolution [m]')
+    parser.add_argument('--x0', type=float, default=500000,
+                        help='x of upper left DTM corner')
+    parser.add_argument('--y0', type=float, default=500000,
+                        help='y of upper left DTM corner')
+    parser.add_argument('--crs', default='EPSG:2180', help='CRS of DTM')
+    parser.add_argument('--eo-crs', type=projected_crs,
+                        help='projected CRS of EO (default CRS of DTM)')
+    parser.add_argument('--photos', type=int, default=100)
+    parser.add_argument('--tilt', type=float, default=0.0,
+                        help='standard deviation of omega, phi [deg]')
+    parser.add_argument('--altitude', type=float, default=600.0,
+                        help='flight altitude above the highest terrain [m]')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--sample', type=int, default=50,
+                        help='photos used by single photo cases')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dtm-file', action='store_true',
+                        help='read DTM from temporary GeoTIFF through '
+                             'tile cache (needs GDAL)')
+    parser.add_argument('--tile-size', type=int, default=512,
+                        help='tile size of DTM cache [pixels]')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='size of DTM cache [MB]')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m flight_planner.benchmarks.run',
+                                     description=__doc__.split('\n\n')[0])
+    scene_arguments(parser)
+    parser.add_argument('--backend', choices=['auto'] + available_backends(),
+                        default='auto', help='backend of kernels')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--design', action='store_true',
+                        help='run design cases too (needs QGIS)')
+    parser.add_argument('--only', nargs='+', help='names of cases to run')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON of previous run')
+    args = parser.parse_args(argv)
+    check_scene_arguments(parser, args)
+
+    args.backend = set_backend(args.backend)
+    results = run(args)
+    if args.output:
+        report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                           'python': sys.version.split()[0],
+                           'numpy': np.__version__,
+                           'platform': platform.platform(),
+                           'args': vars(args)},
+                  'results': results}
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=4)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Generators of synthetic DTMs and blocks of Exterior Orientation
+parameters for benchmarks.
+"""
+
+from math import ceil, sqrt
+
+import numpy as np
+
+from ..functions import get_transformer, transf_coord
+
+
+def synthetic_dtm(kind='fractal', size=2000, res=1.0, origin=(500000, 500000),
+                  base=100.0, relief=300.0, seed=0):
+    """Return DTM array (float32) of size x size pixels and its geotransform.
+    Kind is 'flat', 'sloped' (plane rising along the diagonal) or 'fractal'
+    (mountains made by spectral synthesis of noise)."""
+    geotransform = [origin[0], res, 0, origin[1], 0, -res]
+    if kind == 'flat':
+        dtm = np.full((size, size), base)
+    elif kind == 'sloped':
+        rows, cols = np.mgrid[0:size, 0:size]
+        dtm = base + relief * (rows + cols) / (2 * max(size - 1, 1))
+    elif kind == 'fractal':
+        rng = np.random.default_rng(seed)
+        noise = np.fft.rfft2(rng.normal(size=(size, size)))
+        ky = np.fft.fftfreq(size)[:, None]
+        kx = np.fft.rfftfreq(size)[None, :]
+        k = np.hypot(kx, ky)
+        k[0, 0] = 1
+        # power spectrum 1/k^(2H+2), H = 0.8 gives natural looking terrain
+        surface = np.fft.irfft2(noise / k ** 1.8, s=(size, size))
+        surface -= surface.min()
+        dtm = base + relief * surface / max(surface.max(), 1e-12)
+    else:
+        raise ValueError(f'Unknown DTM kind {kind!r}')
+    return dtm.astype(np.float32), geotransform
+
+
+def eo_block(n, dtm, geotransform, altitude_AGL=600.0, tilt=0.0, seed=0,
+             crs_dtm=None, crs_eo=None):
+    """Return array of n Exterior Orientation parameters
+    (X, Y, Z, omega, phi, kappa) of a block of strips covering the DTM.
+    Z is above sea level, omega and phi are normally distributed with
+    standard deviation 'tilt' [deg] (0 gives nadir photos). Coordinates
+    are transformed to crs_eo if it differs from crs_dtm."""
+    rng = np.random.default_rng(seed)
+    rows, cols = dtm.shape
+    width = cols * geotransform[1]
+    height = rows * -geotransform[5]
+    # photos per strip and number of strips keep the block square
+    per_strip = max(int(ceil(sqrt(n * width / height))), 1)
+    strips = int(ceil(n / per_strip))
+    strip_nr, photo_nr = np.divmod(np.arange(n), per_strip)
+    # odd strips are flown back
+    odd = strip_nr % 2 == 1
+    photo_nr[odd] = per_strip - 1 - photo_nr[odd]
+    X = geotransform[0] + (photo_nr + 0.5) * width / per_strip
+    Y = geotransform[3] - (strip_nr + 0.5) * height / strips
+    Z = np.full(n, float(dtm.max()) + altitude_AGL)
+    omega = rng.normal(0, tilt, n) if tilt else np.zeros(n)
+    phi = rng.normal(0, tilt, n) if tilt else np.zeros(n)
+    kappa = np.where(odd, 180.0, 0.0)
+    if crs_dtm is not None and crs_eo is not None:
+        X, Y = transf_coord(get_transformer(crs_dtm, crs_eo), X, Y)
+    return np.column_stack((X, Y, Z, omega, phi, kappa))
+
+
+def write_geotiff(path, dtm, geotransform, crs, block_size=256):
+    """Write DTM array as tiled GeoTIFF and return the opened GDAL dataset.
+    GDAL is imported only here, benchmarks on DTM in memory run
+    without it."""
+    from osgeo import gdal, gdal_array, osr
+
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(
+        path, xsize=dtm.shape[1], ysize=dtm.shape[0], bands=1,
+        eType=gdal_array.NumericTypeCodeToGDALTypeCode(dtm.dtype),
+        options=['TILED=YES', f'BLOCKXSIZE={block_size}',
+                 f'BLOCKYSIZE={block_size}'])
+    dataset.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(dtm)
+    dataset = None
+    return gdal.Open(path)
@@ -0,0 +1,168 @@
+"""
+Checkpoints of quality control runs. Photos are processed in the order
+of the projection centres layer, so the state of a run is the number of
+photos done, their footprints and the overlapping and GSD mosaic.
+The state is saved at regular intervals and when the run is stopped,
+a later run on the same inputs resumes from it.
+"""
+
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .result_cache import photo_key
+
+
+def run_key(eo, windows, common):
+    """Return hash of all inputs of control run: EO parameters and DTM
+    windows of all photos and parameters common for all photos."""
+    return photo_key(eo, windows, common)
+
+
+class Checkpoint():
+    """Directory with the state of one control run. Footprints are saved
+    in chunks (only the new ones with every save), so are the mosaic
+    arrays: only the block of pixels changed since the previous save
+    is written, in files named by the number of photos done. The state
+    (number of photos done, covered range of mosaic, list of saved
+    blocks) is written last, so an interrupted save leaves the previous
+    state readable."""
+
+    def __init__(self, directory, key, interval=60):
+        self.directory = os.path.join(directory, key)
+        self.interval = interval
+        self.last_save = time.monotonic()
+        # saved blocks of mosaic arrays: photos done, first row and column
+        self.blocks = []
+
+    def due(self):
+        """Check if interval from the last save has passed."""
+        return time.monotonic() - self.last_save >= self.interval
+
+    def load(self, mosaic=None):
+        """Return number of photos done and list of their footprints,
+        restore overlapping and GSD arrays of mosaic (MosaicAccumulator).
+        Return (0, []) if there is no usable checkpoint."""
+        state_path = os.path.join(self.directory, 'state.npz')
+        try:
+            with np.load(state_path) as state:
+                done = int(state['done'])
+                covered = state['covered']
+                blocks = state['blocks'].reshape((-1, 3)).tolist()
+            footprints = []
+            for start in sorted(self.chunks()):
+                if start >= done:
+                    break
+                with np.load(self.chunk_path(start)) as chunk:
+                    footprints += np.split(chunk['vertices'],
+                                           np.cumsum(chunk['counts'])[:-1])
+            if len(footprints) < done:
+                return 0, []
+            if mosaic is not None:
+                # blocks are mapped and checked first, so only usable
+                # checkpoint changes the mosaic
+                arrays = []
+                for saved, row, col in blocks:
+                    overlay = np.load(self.array_path('overlay', saved),
+                                      mmap_mode='r')
+                    gsd = np.load(self.array_path('gsd', saved),
+                                  mmap_mode='r')
+                    if overlay.shape != gsd.shape \
+                            or row + overlay.shape[0] > mosaic.shape[0] \
+                            or col + overlay.shape[1] > mosaic.shape[1]:
+                        return 0, []
+                    arrays.append((row, col, overlay, gsd))
+                # blocks are copied in order of saves in blocks of rows,
+                # the mosaic may be larger than memory
+                for row, col, overlay, gsd in arrays:
+                    cols = slice(col, col + overlay.shape[1])
+                    for start, stop in mosaic.row_blocks(0, overlay.shape[0]):
+                        rows = slice(row + start, row + stop)
+                        mosaic.overlay[rows, cols] = overlay[start:stop]
+                        mosaic.gsd[rows, cols] = gsd[start:stop]
+                del arrays
+                mosaic.covered = covered.tolist() if covered.size else None
+        except (OSError, ValueError, KeyError):
+            return 0, []
+        self.blocks = blocks
+        return done, footprints[:done]
+
+    def chunks(self):
+        """Return first photo indices of saved footprint chunks."""
+        if not os.path.isdir(self.directory):
+            return []
+        return [int(name[11:-4]) for name in os.listdir(self.directory)
+                if name.startswith('footprints_') and name.endswith('.npz')]
+
+    def chunk_path(self, start):
+        return os.path.join(self.directory, f'footprints_{start:08d}.npz')
+
+    def array_path(self, name, done):
+        return os.path.join(self.directory, f'{name}_{done:08d}.npy')
+
+    def save(self, done, new_footprints, mosaic=None):
+        """Save state after 'done' photos, new_footprints are the footprints
+        of photos processed since the previous save. Only the pixels
+        of mosaic changed since the previous save are written, so the cost
+        of a save depends on the progress, not on the size of mosaic."""
+        os.makedirs(self.directory, exist_ok=True)
+        if new_footprints:
+            counts = [vertices.shape[0] for vertices in new_footprints]
+            self.write(self.chunk_path(done - len(new_footprints)),
+                       vertices=np.vstack(new_footprints),
+                       counts=np.array(counts))
+        covered = []
+        blocks = list(self.blocks)
+        if mosaic is not None:
+            covered = mosaic.covered or []
+            if mosaic.changed is not None:
+                r0, r1, c0, c1 = mosaic.changed
+                for name, array in (('overlay', mosaic.overlay),
+                                    ('gsd', mosaic.gsd)):
+                    self.write_block(self.array_path(name, done), array,
+                                     mosaic.row_blocks(r0, r1 + 1), c0, c1)
+                blocks.append([done, r0, c0])
+        self.write(os.path.join(self.directory, 'state.npz'),
+                   done=np.array(done), covered=np.array(covered, dtype=int),
+                   blocks=np.array(blocks, dtype=int).reshape((-1, 3)))
+        self.blocks = blocks
+        if mosaic is not None:
+            mosaic.changed = None
+        # blocks not listed in the state are not needed any more
+        saved = {block[0] for block in blocks}
+        for name in os.listdir(self.directory):
+            if name.startswith(('overlay_', 'gsd_')) and name.endswith('.npy') \
+                    and int(name.split('_')[1][:-4]) not in saved:
+                os.remove(os.path.join(self.directory, name))
+        self.last_save = time.monotonic()
+
+    def write_block(self, path, array, row_blocks, first_col, last_col):
+        """Write columns first_col to last_col of rows given by row_blocks
+        (ranges of rows, see MosaicAccumulator.row_blocks) of array
+        to .npy file, through temporary file like write."""
+        row_blocks = list(row_blocks)
+        first_row = row_blocks[0][0]
+        tmp_path = path + '.tmp'
+        block = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=array.dtype,
+            shape=(row_blocks[-1][1] - first_row, last_col - first_col + 1))
+        for start, stop in row_blocks:
+            block[start - first_row:stop - first_row] = \
+                array[start:stop, first_col:last_col + 1]
+        block.flush()
+        del block
+        os.replace(tmp_path, path)
+
+    def write(self, path, **arrays):
+        """Write arrays to temporary file first and then replace path,
+        so readers never see partial file."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_path, path)
+
+    def remove(self):
+        """Remove checkpoint of finished run."""
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,253 @@
+"""
+Access layer for DTM rasters. DTMTileCache reads only the needed windows
+of the DTM and keeps decoded tiles in a size-bounded LRU cache, so
+neighbouring photos reuse the same tiles instead of decoding the whole
+raster again. ArrayDTM offers the same interface for DTM already held
+in memory.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from .functions import crs2pixel, transf_coord
+
+
+def height_dtype(dtype, nodata=None):
+    """Return data type used to keep DTM heights in memory: float64
+    heights are kept as float32 (sub-millimetre precision for any
+    terrain height), unless nodata value is out of float32 range,
+    other types are already compact."""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f' and dtype.itemsize > 4:
+        with np.errstate(over='ignore'):
+            if nodata is not None and np.isfinite(nodata) \
+                    and np.isinf(np.float32(nodata)):
+                return dtype
+        return np.dtype(np.float32)
+    return dtype
+
+
+def nodata_value(nodata, dtype):
+    """Return nodata value in data type of heights, so it matches
+    heights converted to this type. Value which no height of integer
+    type can have is returned unchanged."""
+    if nodata is None:
+        return None
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        if nodata != int(nodata) or not info.min <= nodata <= info.max:
+            return nodata
+    return dtype.type(nodata)
+
+
+class DTMTileCache():
+    """Windowed reader of the first band of GDAL dataset with LRU cache
+    of decoded tiles."""
+
+    def __init__(self, dataset, tile_size=512, max_bytes=256 * 1024**2):
+        self.dataset = dataset
+        self.band = dataset.GetRasterBand(1)
+        self.geotransform = list(dataset.GetGeoTransform())
+        self.shape = (dataset.RasterYSize, dataset.RasterXSize)
+        nodata = self.band.GetNoDataValue()
+        self.dtype = height_dtype(self.band.ReadAsArray(0, 0, 1, 1).dtype,
+                                  nodata)
+        self.nodata = nodata_value(nodata, self.dtype)
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def tile(self, tile_r, tile_c):
+        """Return decoded tile, read it from dataset if not cached."""
+        key = (tile_r, tile_c)
+        if key in self.tiles:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        self.misses += 1
+        yoff = tile_r * self.tile_size
+        xoff = tile_c * self.tile_size
+        ysize = min(self.tile_size, self.shape[0] - yoff)
+        xsize = min(self.tile_size, self.shape[1] - xoff)
+        tile_array = self.band.ReadAsArray(xoff, yoff, xsize, ysize)
+        self.bytes_read += tile_array.nbytes
+        tile_array = tile_array.astype(self.dtype, copy=False)
+
+        self.tiles[key] = tile_array
+        self.cached_bytes += tile_array.nbytes
+        # evict least recently used tiles, but always keep the last one
+        while self.cached_bytes > self.max_bytes and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+        return tile_array
+
+    def read(self, xoff, yoff, xsize, ysize):
+        """Return window of DTM, the same as
+        ReadAsArray(xoff, yoff, xsize, ysize) on the whole raster
+        sliced to the range of the raster."""
+        row_end = min(yoff + ysize, self.shape[0])
+        col_end = min(xoff + xsize, self.shape[1])
+        rows = max(row_end - yoff, 0)
+        cols = max(col_end - xoff, 0)
+        window = np.empty((rows, cols), dtype=self.dtype)
+        if rows == 0 or cols == 0:
+            return window
+
+        ts = self.tile_size
+        for tile_r in range(yoff // ts, (row_end - 1) // ts + 1):
+            for tile_c in range(xoff // ts, (col_end - 1) // ts + 1):
+                tile_array = self.tile(tile_r, tile_c)
+                # common part of window and tile in raster pixels
+                r0 = max(yoff, tile_r * ts)
+                r1 = min(row_end, tile_r * ts + tile_array.shape[0])
+                c0 = max(xoff, tile_c * ts)
+                c1 = min(col_end, tile_c * ts + tile_array.shape[1])
+                window[r0 - yoff:r1 - yoff, c0 - xoff:c1 - xoff] = \
+                    tile_array[r0 - tile_r * ts:r1 - tile_r * ts,
+                               c0 - tile_c * ts:c1 - tile_c * ts]
+        return window
+
+    def minmax(self):
+        """Return minimum and maximum height of DTM, without nodata."""
+        min_h, max_h = self.band.ComputeRasterMinMax(False)
+        return min_h, max_h
+
+    def clear(self):
+        """Drop all cached tiles."""
+        self.tiles.clear()
+        self.cached_bytes = 0
+
+    def stats(self):
+        """Return dictionary with cache counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'bytes_read': self.bytes_read,
+                'cached_tiles': len(self.tiles),
+                'cached_bytes': self.cached_bytes}
+
+
+class ArrayDTM():
+    """DTM held in memory (e.g. in shared memory of worker processes)
+    with the same interface as DTMTileCache. The array may hold only
+    a window of the raster, starting at offset (column, row), while
+    geotransform and shape describe the whole raster."""
+
+    def __init__(self, array, geotransform, nodata=None, offset=(0, 0),
+                 shape=None):
+        self.array = array
+        self.geotransform = list(geotransform)
+        self.offset = offset
+        self.shape = array.shape if shape is None else tuple(shape)
+        self.dtype = array.dtype
+        self.nodata = nodata_value(nodata, self.dtype)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def read(self, xoff, yoff, xsize, ysize):
+        """Return copy of DTM window sliced to the range of the raster."""
+        col = max(xoff, 0) - self.offset[0]
+        row = max(yoff, 0) - self.offset[1]
+        window = np.array(self.array[max(row, 0):row + max(ysize, 0),
+                                     max(col, 0):col + max(xsize, 0)])
+        self.hits += 1
+        self.bytes_read += window.nbytes
+        return window
+
+    def minmax(self):
+        """Return minimum and maximum height of DTM, without nodata."""
+        if self.nodata is None:
+            valid = self.array
+        else:
+            valid = self.array[self.array != self.nodata]
+        return float(np.nanmin(valid)), float(np.nanmax(valid))
+
+    def stats(self):
+        """Return dictionary with access counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'bytes_read': self.bytes_read,
+                'cached_tiles': 0,
+                'cached_bytes': self.array.nbytes}
+
+
+def sample_heights(dtm, x, y, transformer=None, method='nearest'):
+    """Return DTM heights at points given by arrays of coordinates.
+    Coordinates are reprojected to DTM CRS with transformer (if given)
+    in one call. 'nearest' returns value of the pixel containing
+    the point, 'bilinear' interpolates between pixel centroids.
+    Points outside DTM or on nodata get NaN."""
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = np.atleast_1d(np.asarray(y, dtype=float))
+    heights = np.full(x.shape, np.nan)
+    if not x.size:
+        return heights
+    if transformer is not None:
+        x, y = transf_coord(transformer, x, y)
+    column, row = crs2pixel(dtm.geotransform, np.asarray(x), np.asarray(y))
+    inside = (column >= 0) & (row >= 0) \
+        & (column < dtm.shape[1]) & (row < dtm.shape[0])
+    if not inside.any():
+        return heights
+    if method == 'bilinear':
+        # interpolation is done between centroids of pixels
+        column = column - 0.5
+        row = row - 0.5
+
+    # points are sampled in groups of one DTM tile, so no window is
+    # larger than a tile (plus one pixel for interpolation) and heights
+    # keep the data type of DTM until they are sampled
+    tile_size = getattr(dtm, 'tile_size', 512)
+    points = np.flatnonzero(inside)
+    tile_r = np.maximum(np.floor(row[points]), 0).astype(int) // tile_size
+    tile_c = np.maximum(np.floor(column[points]), 0).astype(int) // tile_size
+    groups = tile_r * (dtm.shape[1] // tile_size + 1) + tile_c
+    order = np.argsort(groups, kind='stable')
+    points = points[order]
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+    for group in np.split(points, bounds):
+        heights[group] = sample_window(dtm, column[group], row[group],
+                                       method)
+    return heights
+
+
+def sample_window(dtm, column, row, method='nearest'):
+    """Return heights of DTM at pixel coordinates of points inside DTM
+    (see sample_heights), reading one window covering the points."""
+    c0 = max(int(np.floor(column.min())), 0)
+    r0 = max(int(np.floor(row.min())), 0)
+    c1 = min(int(np.floor(column.max())) + 1, dtm.shape[1] - 1)
+    r1 = min(int(np.floor(row.max())) + 1, dtm.shape[0] - 1)
+    window = dtm.read(c0, r0, c1 - c0 + 1, r1 - r0 + 1)
+    col = column - c0
+    row = row - r0
+
+    def values(r, c):
+        """Return heights of window pixels as floats, nodata as NaN."""
+        heights = window[r, c].astype(float)
+        if dtm.nodata is not None:
+            heights[window[r, c] == dtm.nodata] = np.nan
+        return heights
+
+    if method == 'bilinear':
+        col = np.clip(col, 0, window.shape[1] - 1)
+        row = np.clip(row, 0, window.shape[0] - 1)
+        c_left = np.minimum(np.floor(col).astype(int), window.shape[1] - 2)
+        r_top = np.minimum(np.floor(row).astype(int), window.shape[0] - 2)
+        c_left, r_top = np.maximum(c_left, 0), np.maximum(r_top, 0)
+        c_right = np.minimum(c_left + 1, window.shape[1] - 1)
+        r_bottom = np.minimum(r_top + 1, window.shape[0] - 1)
+        dc = np.clip(col - c_left, 0, 1)
+        dr = np.clip(row - r_top, 0, 1)
+        top = values(r_top, c_left) * (1 - dc) + values(r_top, c_right) * dc
+        bottom = values(r_bottom, c_left) * (1 - dc) \
+            + values(r_bottom, c_right) * dc
+        return top * (1 - dr) + bottom * dr
+    return values(np.floor(row).astype(int), np.floor(col).astype(int))
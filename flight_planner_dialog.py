@@ -28,26 +28,26 @@ from math import sqrt, ceil, fabs, pi, atan2, atan
 
 import processing
 from osgeo import gdal
-from pyproj import Transformer
 from PyQt5.QtWidgets import QMessageBox, QInputDialog
-from PyQt5.QtCore import pyqtSlot, QVariant, QThread
+from PyQt5.QtCore import pyqtSlot, QSettings, QVariant, QThread
 from qgis.PyQt import uic, QtWidgets
 from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsField,
     QgsFieldProxyModel,
     QgsMapLayerProxyModel,
-    QgsProject,
-    QgsPointXY
+    QgsProject
 )
 
 from .camera import Camera
 from .worker import Worker
+from .dtm import DTMTileCache, sample_heights
 from .functions import (
     corridor_flight_numbering,
     bounding_box_at_angle,
     projection_centres,
     line,
+    get_transformer,
     transf_coord,
     minmaxheight,
     save_error
@@ -95,6 +95,9 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
             "Separate Altitude ASL For Each Strip",
             "Terrain Following"])
 
+        # processes used by quality control, one means no process pool
+        self.spinBoxProcesses.setMaximum(os.cpu_count() or 1)
+
         # Set up ComboBox of camera
         self.cameras_file = os.path.join(
             os.path.dirname(os.path.abspath(__file__)), 'cameras.json')
@@ -125,6 +128,8 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
         worker.finished.connect(self.workerFinished)
         worker.error.connect(self.workerError)
         worker.progress.connect(self.progressBarControl.setValue)
+        worker.stats.connect(self.showRunStats)
+        worker.message.connect(self.workerMessage)
         worker.enabled.connect(self.pushButtonRunControl.setEnabled)
         worker.enabled.connect(self.pushButtonRunDesign.setEnabled)
         thread.started.connect(worker.run_control)
@@ -174,6 +179,10 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
         QMessageBox.about(self, 'Error', 'See error log file in plugin folder')
 
 
+    def workerMessage(self, text):
+        """Show warning or information about the run from worker."""
+        QMessageBox.about(self, 'Quality control', text)
+
     def check_set_gsd(self):
         gsd = (self.doubleSpinBoxAltAGL.value()*100) \
             / (self.doubleSpinBoxFocalLength.value()/10) \
@@ -208,6 +217,19 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
     def on_progressBarControl_valueChanged(self):
         pass
 
+    def showRunStats(self, stats):
+        """Show backend of kernels and estimated remaining time of control
+        run on progress bar."""
+        eta = stats.get('eta_s')
+        backend = stats.get('info', {}).get('backend')
+        text = '%p%' if backend is None else f'%p%  [{backend}]'
+        if eta is None or stats.get('done') == stats.get('total'):
+            self.progressBarControl.setFormat(text)
+        else:
+            minutes, seconds = divmod(int(eta), 60)
+            self.progressBarControl.setFormat(
+                f'{text}  (ETA {minutes}:{seconds:02d})')
+
     def on_comboBoxCamera_highlighted(self):
         camera_names = [camera.name for camera in self.cameras]
         items_list = [self.comboBoxCamera.itemText(i) for i in range(self.comboBoxCamera.count())]
@@ -303,6 +325,9 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
     def on_doubleSpinBoxIterationThreshold_valueChanged(self):
         pass
 
+    def on_spinBoxProcesses_valueChanged(self):
+        pass
+
     def on_checkBoxOverlapImages_stateChanged(self):
         pass
 
@@ -396,7 +421,9 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
         if attributes_exist:
             try:
                 if self.tabBlock:
-                    h_min, h_max = minmaxheight(self.AreaOfInterest, self.DTM)
+                    h_min, h_max = minmaxheight(
+                        self.AreaOfInterest, DTMTileCache(self.raster),
+                        get_transformer(self.crs_vct, self.crs_rst))
                 else:
                     g_rst = self.raster.GetGeoTransform()
                     pix_width = g_rst[1]
@@ -409,11 +436,11 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
                     xo1, yo1 = uplx_n, uply_n
                     # setting minimum buffer size to be able to get heights
                     if self.crs_rst != self.crs_vct:
-                        transf_rst_vct = Transformer.from_crs(self.crs_rst,
-                                                            self.crs_vct,
-                                                            always_xy=True)
-                        xo, yo = transf_coord(transf_rst_vct, uplx, uply)
-                        xo1, yo1 = transf_coord(transf_rst_vct, uplx_n, uply_n)
+                        transf_rst_vct = get_transformer(self.crs_rst,
+                                                         self.crs_vct)
+                        (xo, xo1), (yo, yo1) = transf_coord(transf_rst_vct,
+                                                            [uplx, uplx_n],
+                                                            [uply, uply_n])
 
                     min_buff_size = max(ceil(fabs(xo1 - xo)), ceil(fabs(yo1 - yo)))
                     self.doubleSpinBoxBuffer.setMinimum(min_buff_size / 2)
@@ -424,7 +451,9 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
                                             'MITER_LIMIT': 2, 'DISSOLVE': False,
                                             'OUTPUT': 'TEMPORARY_OUTPUT'})
                     self.bufferedLine = buffLine['OUTPUT']
-                    h_min, h_max = minmaxheight(self.bufferedLine, self.DTM)
+                    h_min, h_max = minmaxheight(
+                        self.bufferedLine, DTMTileCache(self.raster),
+                        get_transformer(self.crs_vct, self.crs_rst))
             except:
                 QMessageBox.about(self, 'Error', 'Get heights from DTM failed')
                 save_error()
@@ -660,7 +689,8 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
                                                         distance=dist,
                                                         crsVectorLayer=self.crs_vct,
                                                         crsRasterLayer=self.crs_rst,
-                                                        DTM=self.DTM, 
+                                                        DTM=self.DTM,
+                                                        raster=self.raster,
                                                         altitude_AGL=altitude_AGL,
                                                         polygonLayer=photo_lay,
                                                         strips=s,
@@ -673,6 +703,7 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
                                                         crsVectorLayer=self.crs_vct,
                                                         crsRasterLayer=self.crs_rst,
                                                         DTM=self.DTM,
+                                                        raster=self.raster,
                                                         altitude_AGL=altitude_AGL,
                                                         polygonLayer=photo_lay,
                                                         strips=s,
@@ -688,6 +719,7 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
                                                     crsVectorLayer=self.crs_vct,
                                                     crsRasterLayer=self.crs_rst, 
                                                     DTM=self.DTM,
+                                                    raster=self.raster,
                                                     altitude_AGL=altitude_AGL,
                                                     polygonLayer=photo_lay,
                                                     )
@@ -696,24 +728,20 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
 
                 else:
                     if hasattr(self, 'DTM'):
-                        if self.crs_rst != self.crs_vct:
-                            transf_vct_rst = Transformer.from_crs(self.crs_vct,
-                                                                self.crs_rst,
-                                                                always_xy=True)
-                        feats = pc_lay.getFeatures()
-                        for f in feats:
-                            # projection center coordinates
-                            x = f.geometry().asPoint().x()
-                            y = f.geometry().asPoint().y()
-                            if self.crs_rst != self.crs_vct:
-                                x, y = transf_coord(transf_vct_rst, x, y)
-
+                        transf_vct_rst = get_transformer(self.crs_vct,
+                                                         self.crs_rst)
+                        feats = list(pc_lay.getFeatures())
+                        # projection center coordinates
+                        x = [f.geometry().asPoint().x() for f in feats]
+                        y = [f.geometry().asPoint().y() for f in feats]
+                        terrain_heights = sample_heights(DTMTileCache(self.raster),
+                                                         x, y, transf_vct_rst)
+                        changes = {}
+                        for f, terrain_height in zip(feats, terrain_heights):
                             altitude_ASL = f.attribute('Alt. ASL [m]')
-                            terrain_height, res = self.DTM.dataProvider().sample(QgsPointXY(x, y,), 1)
                             altitude_AGL = altitude_ASL - terrain_height
-                            pc_lay.startEditing()
-                            pc_lay.changeAttributeValue(f.id(), 5, round(altitude_AGL, 2))
-                            pc_lay.commitChanges()
+                            changes[f.id()] = {5: round(altitude_AGL, 2)}
+                        pc_lay.dataProvider().changeAttributeValues(changes)
 
                     # delete redundant fields
                     pc_lay.startEditing()
@@ -770,6 +798,34 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
         if attributes_exist:
             try:
                 threshold = self.doubleSpinBoxIterationThreshold.value()
+                # number of photos sent to a process at once
+                chunk_size = QSettings().value('flight_planner/chunkSize',
+                                               64, type=int)
+                # adaptive sampling of photo edges, 0 means one point
+                # per DTM cell
+                edge_tolerance = QSettings().value(
+                    'flight_planner/edgeTolerance', 0.0, type=float)
+                # results of single photos kept between runs in this
+                # directory, the cache is disabled by default (empty)
+                result_cache = QSettings().value(
+                    'flight_planner/resultCacheDir', '')
+                result_cache_size = QSettings().value(
+                    'flight_planner/resultCacheSize', 1024, type=int)
+                # state of interrupted runs kept in this directory,
+                # the next run on the same inputs resumes from it,
+                # disabled by default (empty)
+                checkpoint_dir = QSettings().value(
+                    'flight_planner/checkpointDir', '')
+                checkpoint_interval = QSettings().value(
+                    'flight_planner/checkpointInterval', 60, type=int)
+                # overlapping and GSD grids larger than this [MB]
+                # are kept in files instead of memory
+                mosaic_memory = QSettings().value(
+                    'flight_planner/mosaicMemory', 2048, type=int)
+                # kernels backend: 'auto', 'numpy' or 'numba' (see README),
+                # the one used is shown on the progress bar and saved
+                # in run report
+                backend = QSettings().value('flight_planner/backend', 'auto')
                 self.startWorker_control(pointLayer=proj_centres,
                                         hField=h_field,
                                         omegaField=o_field,
@@ -784,7 +840,16 @@ class FlightPlannerDialog(QtWidgets.QDialog, FORM_CLASS):
                                         gsd=self.checkBoxGSDmap.isChecked(),
                                         footprint=self.checkBoxFootprint.isChecked(),
                                         threshold=threshold,
-                                        height_is_ASL = self.radioButtonSeaLevel.isChecked())
+                                        height_is_ASL = self.radioButtonSeaLevel.isChecked(),
+                                        workers=self.spinBoxProcesses.value(),
+                                        chunkSize=chunk_size,
+                                        edgeTolerance=edge_tolerance,
+                                        resultCache=result_cache,
+                                        resultCacheSize=result_cache_size * 1024**2,
+                                        checkpointDir=checkpoint_dir,
+                                        checkpointInterval=checkpoint_interval,
+                                        mosaicMemory=mosaic_memory * 1024**2,
+                                        backend=backend)
                 # disable GUI elements to prevent thread from starting
                 # a second time
                 self.pushButtonRunControl.setEnabled(False)
@@ -1,11 +1,14 @@
 """
 Various auxiliary functions for calculations, e.g. projection center
-locations, GSD map.
+locations, GSD map. QGIS is imported only by functions working with
+QGIS layers and geometries, so quality control runs without QGIS.
 """
 
 import os
+import struct
 import time
 import traceback
+from functools import lru_cache
 from math import (
     acos,
     atan,
@@ -20,26 +23,24 @@ from math import (
     tan
 )
 
-import matplotlib.path as mpltPath
 import numpy as np
 import scipy.ndimage as ndimage
-from PyQt5.QtCore import QVariant
-from qgis.analysis import QgsZonalStatistics
-from qgis.core import (
-    QgsFeature,
-    QgsField,
-    QgsGeometry,
-    QgsPointXY,
-    QgsVectorLayer
-)
+from pyproj import Transformer
+
+from .kernels import fill_polygon, gsd_cells, iterate_rays, use_numba
+from .stats import RunStats
+
+# protection against too long iteration of edge rays
+MAX_ITERATIONS = 100
+# iterations of edge rays on every coarse level of DTM pyramid
+COARSE_ITERATIONS = 10
 
 
-def clip_raster(ds, xyf, R, Xs, Ys, Zs, Z_min, trans_v_r, crs_rst, crs_vct):
-    """Return DTM clipped by bounding box of photo. Range of bounding box
-     is derived from photo's Exterior Orientation Parameters, camera parameters
-     and minimum height of DTM"""
+def photo_range(xyf, R, Xs, Ys, Zs, Z_min):
+    """Return corners of bounding box of photo at minimum height
+    of DTM. Range of bounding box is derived from photo's Exterior
+    Orientation Parameters and camera parameters."""
 
-    DTM_array = ds.GetRasterBand(1).ReadAsArray()
     focal = xyf[0, 2]
     img_corners = np.vstack(([0, 0, focal], xyf))
 
@@ -60,12 +61,12 @@ def clip_raster(ds, xyf, R, Xs, Ys, Zs, Z_min, trans_v_r, crs_rst, crs_vct):
                       [max_range_X, min_range_Y],
                       [max_range_X, max_range_Y]
                       ])
+    return range
 
-    if crs_vct != crs_rst:
-        X, Y = transf_coord(trans_v_r, range[:, 0], range[:, 1])
-        cols, rows = crs2pixel(ds.GetGeoTransform(), X, Y)
-    else:
-        cols, rows = crs2pixel(ds.GetGeoTransform(), range[:, 0], range[:, 1])
+
+def pixel_window(dtm, cols, rows):
+    """Return pixel window (first column, first row, last column, last row)
+    of DTM covering given pixel coordinates."""
 
     upper_left_c, upper_left_r = int(min(cols)//1), int(min(rows)//1)
     bottom_right_c, bottom_right_r = int(max(cols)//1), int(max(rows)//1)
@@ -75,65 +76,172 @@ def clip_raster(ds, xyf, R, Xs, Ys, Zs, Z_min, trans_v_r, crs_rst, crs_vct):
     if upper_left_c < 0:
         upper_left_c = 0
 
-    if bottom_right_r > DTM_array.shape[0]:
-        bottom_right_r = DTM_array.shape[0]
-    if bottom_right_c > DTM_array.shape[1]:
-        bottom_right_c = DTM_array.shape[1]
+    if bottom_right_r > dtm.shape[0]:
+        bottom_right_r = dtm.shape[0]
+    if bottom_right_c > dtm.shape[1]:
+        bottom_right_c = dtm.shape[1]
 
-    x0, y0 = pixel2crs(ds.GetGeoTransform(), upper_left_c, upper_left_r)
-    clipped_DTM = np.array(DTM_array[upper_left_r: bottom_right_r+1,
-                           upper_left_c: bottom_right_c+1])
-    updated_geotransform = list(ds.GetGeoTransform())
-    updated_geotransform[0] = x0
-    updated_geotransform[3] = y0
+    return upper_left_c, upper_left_r, bottom_right_c, bottom_right_r
 
-    return clipped_DTM, updated_geotransform
 
+def clip_window(dtm, xyf, R, Xs, Ys, Zs, Z_min, trans_v_r, crs_rst, crs_vct):
+    """Return pixel window (first column, first row, last column, last row)
+    of DTM covering bounding box of photo (see photo_range)."""
+
+    range = photo_range(xyf, R, Xs, Ys, Zs, Z_min)
+    if crs_vct != crs_rst:
+        X, Y = transf_coord(trans_v_r, range[:, 0], range[:, 1])
+        cols, rows = crs2pixel(dtm.geotransform, X, Y)
+    else:
+        cols, rows = crs2pixel(dtm.geotransform, range[:, 0], range[:, 1])
 
-def points_pixel_centroids(geotransform, shape):
-    """Return pixel centroids for the raster."""
+    return pixel_window(dtm, cols, rows)
 
-    upx = geotransform[0]
-    upy = geotransform[3]
-    xscale = geotransform[1]
-    yscale = geotransform[5]
-    xskew = geotransform[2]
-    yskew = geotransform[4]
-    pc = sqrt(xscale ** 2 + yskew ** 2)
-    pr = sqrt(yscale ** 2 + xskew ** 2)
-    alpha = acos(xscale / pc)
 
-    x_grid = np.arange(0, shape[1]*pc, pc)
-    y_grid = np.arange(0, -shape[0]*pr, -pr)
-    xv, yv = np.meshgrid(x_grid[:shape[1]], y_grid[:shape[0]])
+def clip_raster(dtm, xyf, R, Xs, Ys, Zs, Z_min, trans_v_r, crs_rst, crs_vct):
+    """Return DTM clipped by bounding box of photo. Only the window
+    of the bounding box is read from the DTM (see DTMTileCache)."""
 
-    xx = xv.reshape((-1, 1))
-    yy = yv.reshape((-1, 1))
+    upper_left_c, upper_left_r, bottom_right_c, bottom_right_r = clip_window(
+        dtm, xyf, R, Xs, Ys, Zs, Z_min, trans_v_r, crs_rst, crs_vct)
 
-    x_start = upx + 1 / 2 * pc
-    y_start = upy - 1 / 2 * pr
-    centroid_x = x_start + np.cos(-alpha)*xx + np.sin(-alpha)*yy
-    centroid_y = y_start + -np.sin(-alpha)*xx + np.cos(-alpha)*yy
+    x0, y0 = pixel2crs(dtm.geotransform, upper_left_c, upper_left_r)
+    clipped_DTM = dtm.read(upper_left_c, upper_left_r,
+                           bottom_right_c - upper_left_c + 1,
+                           bottom_right_r - upper_left_r + 1)
+    updated_geotransform = list(dtm.geotransform)
+    updated_geotransform[0] = x0
+    updated_geotransform[3] = y0
 
-    return np.hstack((centroid_x, centroid_y))
+    return clipped_DTM, updated_geotransform
 
 
-def overlap_photo(footprint_vertices, geotransform, clipped_DTM_shape):
-    """Return logical array of photo's footprint."""
+def photos_windows(dtm, xyf_corners, eo, Z_min, trans_v_r, crs_rst, crs_vct,
+                   R_all=None):
+    """Return array of DTM windows (see clip_window) of every photo
+    of EO array (X, Y, Z, omega, phi, kappa)."""
 
-    raster_centroids = points_pixel_centroids(geotransform, clipped_DTM_shape)
+    eo = np.asarray(eo, dtype=float).reshape((-1, 6))
+    if R_all is None:
+        R_all = [rotation_matrix(omega, phi, kappa)
+                 for omega, phi, kappa in eo[:, 3:]]
+    ranges = np.array([photo_range(xyf_corners, R, Xs, Ys, Zs, Z_min)
+                       for R, (Xs, Ys, Zs) in zip(R_all, eo[:, :3])])
+    ranges = ranges.reshape((-1, 2))
+    # corners of all photos are transformed at once
+    if crs_vct != crs_rst:
+        X, Y = transf_coord(trans_v_r, ranges[:, 0], ranges[:, 1])
+        cols, rows = crs2pixel(dtm.geotransform, X, Y)
+    else:
+        cols, rows = crs2pixel(dtm.geotransform, ranges[:, 0], ranges[:, 1])
+    windows = [pixel_window(dtm, cols[i:i + 4], rows[i:i + 4])
+               for i in range(0, len(cols), 4)]
+    return np.array(windows, dtype=int).reshape((-1, 4))
+
+
+def window_groups(windows, max_ratio=4):
+    """Split consecutive DTM windows into groups, whose common bounding
+    window is not larger than max_ratio times the sum of windows area.
+    Return list of (indices of windows, common window)."""
+
+    def area(w):
+        return (w[2] - w[0] + 1) * (w[3] - w[1] + 1)
+
+    groups = []
+    indices, union, sum_area = [], None, 0
+    for i, w in enumerate(windows):
+        if union is None:
+            indices, union, sum_area = [i], tuple(w), area(w)
+            continue
+        new_union = (min(union[0], w[0]), min(union[1], w[1]),
+                     max(union[2], w[2]), max(union[3], w[3]))
+        if area(new_union) <= max_ratio * (sum_area + area(w)):
+            indices.append(i)
+            union, sum_area = new_union, sum_area + area(w)
+        else:
+            groups.append((indices, union))
+            indices, union, sum_area = [i], tuple(w), area(w)
+    if union is not None:
+        groups.append((indices, union))
+    return groups
+
+
+def polygon_mask(columns, rows, shape):
+    """Return logical array of pixels, whose centroids lie inside polygon
+    given by vertices in pixel coordinates, limited to bounding box
+    of polygon, and the first column and row of the bounding box.
+    Scanline rasterization with even-odd rule."""
+
+    columns = np.asarray(columns, dtype=float)
+    rows = np.asarray(rows, dtype=float)
+    # centroid of pixel (r, c) has pixel coordinates (r + 0.5, c + 0.5)
+    first_r = max(int(ceil(rows.min() - 0.5)), 0)
+    last_r = min(int(ceil(rows.max() - 0.5)) - 1, shape[0] - 1)
+    first_c = max(int(ceil(columns.min() - 0.5)), 0)
+    last_c = min(int(ceil(columns.max() - 0.5)) - 1, shape[1] - 1)
+    n_rows = max(last_r - first_r + 1, 0)
+    n_cols = max(last_c - first_c + 1, 0)
+    if n_rows == 0 or n_cols == 0:
+        return np.zeros((n_rows, n_cols), dtype=bool), first_c, first_r
+    if use_numba():
+        mask = np.zeros((n_rows, n_cols), dtype=bool)
+        fill_polygon(columns, rows, first_c, first_r, mask)
+        return mask, first_c, first_r
+
+    # edges of polygon and scanlines crossed by them: lo <= r + 0.5 < hi
+    r0, c0 = rows, columns
+    r1, c1 = np.roll(rows, -1), np.roll(columns, -1)
+    lo = np.minimum(r0, r1)
+    hi = np.maximum(r0, r1)
+    start = np.maximum(np.ceil(lo - 0.5), first_r).astype(int)
+    stop = np.minimum(np.ceil(hi - 0.5) - 1, last_r).astype(int)
+    n = np.maximum(stop - start + 1, 0)
+
+    edge = np.repeat(np.arange(n.size), n)
+    scanline = start[edge] + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    y = scanline + 0.5
+    x = c0[edge] + (y - r0[edge]) * (c1[edge] - c0[edge]) / (r1[edge] - r0[edge])
+
+    # pairs of crossings along every scanline bound the inner pixels
+    order = np.lexsort((x, scanline))
+    scanline = scanline[order][0::2] - first_r
+    x_in, x_out = x[order][0::2], x[order][1::2]
+    c_in = np.clip(np.ceil(x_in - 0.5) - first_c, 0, n_cols).astype(int)
+    c_out = np.clip(np.ceil(x_out - 0.5) - first_c, 0, n_cols).astype(int)
+
+    inside = np.zeros((n_rows, n_cols + 1), dtype=np.int32)
+    np.add.at(inside, (scanline, c_in), 1)
+    np.add.at(inside, (scanline, c_out), -1)
+    mask = np.cumsum(inside, axis=1)[:, :-1] > 0
+
+    return mask, first_c, first_r
+
+
+def pack_mask(mask):
+    """Return logical array packed to bits along rows (8 times smaller)
+    and its number of columns."""
+    return np.packbits(mask, axis=1), mask.shape[1]
+
+
+def unpack_mask(bits, columns):
+    """Return logical array packed by pack_mask."""
+    return np.unpackbits(bits, axis=1, count=columns).view(bool)
 
-    path = mpltPath.Path(footprint_vertices)
-    centroids_inside = path.contains_points(raster_centroids)
 
-    logical_array = centroids_inside.reshape((clipped_DTM_shape[0], -1))
+def overlap_photo(footprint_vertices, geotransform, clipped_DTM_shape):
+    """Return logical array of photo's footprint."""
+
+    columns, rows = crs2pixel(geotransform, footprint_vertices[:, 0],
+                              footprint_vertices[:, 1])
+    mask, first_c, first_r = polygon_mask(columns, rows, clipped_DTM_shape)
 
-    max_row, max_col = np.argwhere(logical_array > 0).max(axis=0)
-    min_row, min_col = np.argwhere(logical_array > 0).min(axis=0)
+    max_row, max_col = np.argwhere(mask).max(axis=0)
+    min_row, min_col = np.argwhere(mask).min(axis=0)
 
-    trimed_logical_array = logical_array[min_row:max_row+1, min_col:max_col+1]
+    trimed_logical_array = mask[min_row:max_row+1, min_col:max_col+1]
 
-    upper_left_x, upper_left_y = pixel2crs(geotransform, min_col, min_row)
+    upper_left_x, upper_left_y = pixel2crs(geotransform, min_col + first_c,
+                                           min_row + first_r)
     trimed_geotransform = geotransform[:]
     trimed_geotransform[0] = upper_left_x
     trimed_geotransform[3] = upper_left_y
@@ -141,81 +249,148 @@ def overlap_photo(footprint_vertices, geotransform, clipped_DTM_shape):
     return trimed_logical_array, trimed_geotransform
 
 
-def gsd(DTM, geotransform, Xs, Ys, Zs, Xs_, Ys_, Zs_, f, size_sensor):
-    """Return GSD array."""
-
-    vect_vertical = np.array([0, 0, -1])
-    vect_camera_axis = [Xs_ - Xs, Ys_ - Ys, Zs_ - Zs]
-    # tilt angle of photo
-    t = angle_between_vectors(vect_vertical, vect_camera_axis)
-    if t == 0:
-        gsd_array = ((Zs - DTM) * size_sensor / f) * 100
-    else:
-        # photo's greatest fall line
-        a, b = line(Ys, Ys_, Xs, Xs_)
-        # line perpendicular to photo's greatest fall line
-        if a != 0:
-            a_l_ = -1 / a
-        else:
-            a_l_ = -1 / 0.000000000000000001
-
-        pxpy = points_pixel_centroids(geotransform, DTM.shape)
-        px = pxpy[:, 0]
-        py = pxpy[:, 1]
-
-        b_l_ = py - a_l_ * px
-        # projection point on photo's greatest fall line
-        ppx, ppy = lines_intersection(a_l_, b_l_, a, b)
-        # vector projection center - projection point
-        Z = DTM
-        vect_S_pp = np.array([ppx - Xs, ppy - Ys, (Z - Zs).flatten()])
-
-        beta = angle_between_vectors(vect_vertical, vect_S_pp)
-
-        direction = angle_between_vectors((vect_camera_axis[0],
-                                           vect_camera_axis[1]),
-                                          (vect_S_pp[0],
-                                           vect_S_pp[1]))
+def gsd(DTM, geotransform, Xs, Ys, Zs, R, f, size_sensor):
+    """Return GSD array [cm] of photo with rotation matrix R.
+    GSD of every DTM cell is proportional to the distance of the cell
+    from projection centre measured along the camera axis."""
+
+    # camera axis in object space
+    axis = -R[:, 2]
+    rows = np.arange(DTM.shape[0]) + 0.5
+    columns = np.arange(DTM.shape[1]) + 0.5
+    # coordinates of pixel centroids are linear in column and row,
+    # so the horizontal part of the distance splits into two vectors
+    x0 = geotransform[0] - Xs
+    y0 = geotransform[3] - Ys
+    col_part = axis[0] * (x0 + columns * geotransform[1]) \
+        + axis[1] * (y0 + columns * geotransform[4])
+    row_part = axis[0] * rows * geotransform[2] \
+        + axis[1] * rows * geotransform[5]
+
+    scale = np.float32(size_sensor / f * 100)
+    if use_numba():
+        gsd_array = np.empty(DTM.shape, dtype=np.float32)
+        gsd_cells(DTM, np.float32(Zs), np.float32(axis[2]),
+                  row_part.astype(np.float32), col_part.astype(np.float32),
+                  scale, gsd_array)
+        return gsd_array
+    gsd_array = np.asarray(DTM, dtype=np.float32) - np.float32(Zs)
+    gsd_array *= np.float32(axis[2])
+    gsd_array += row_part.astype(np.float32)[:, None]
+    gsd_array += col_part.astype(np.float32)[None, :]
+    gsd_array *= scale
+    return gsd_array
 
-        correct_beta = np.where(direction >= 90, -beta, beta).reshape(Z.shape)
 
-        W = Zs - Z
-        gsd_array = size_sensor * (W/f) * np.cos(np.radians(correct_beta - t)) \
-                          / np.cos(np.radians(correct_beta)) * 100
-    return gsd_array
+def dtm_pyramid(Z_DTM, geotransform, min_size=32, max_levels=3):
+    """Return list of coarser levels (DTM, geotransform) of DTM, coarsest
+    first. Every level takes every second pixel of the finer one (views
+    of the DTM, nothing is copied), levels are built while they have
+    at least min_size pixels in both directions."""
+    levels = []
+    Z, geot = Z_DTM, list(geotransform)
+    while len(levels) < max_levels and min(Z.shape) >= 2 * min_size:
+        Z = Z[::2, ::2]
+        # pixel size and rotation terms, so rotated DTM keeps its angle
+        geot = [geot[0], geot[1] * 2, geot[2] * 2,
+                geot[3], geot[4] * 2, geot[5] * 2]
+        levels.append((Z, geot))
+    return levels[::-1]
+
+
+def ground_edge_points_batch(R, Z, threshold, xyf_list, Xs, Ys, Zs,
+                             Z_DTM, geotransform, crs_DTM, crs_pc, transformer,
+                             max_iterations=MAX_ITERATIONS, pyramid=None):
+    """Return list of ground coordinates of points representing edges
+    of many photos and number of full resolution iterations done for each
+    photo. Edge rays of all photos are iterated together, every ray stops
+    when its position changes less than threshold. Rays converge on the
+    coarse levels of DTM pyramid (see dtm_pyramid, built if not given)
+    first, so only the last few steps are done at full resolution."""
+
+    R = np.asarray(R, dtype=float).reshape((-1, 3, 3))
+    counts = [xyf.shape[0] for xyf in xyf_list]
+    photo = np.repeat(np.arange(len(counts)), counts)
+    xyf = np.vstack(xyf_list)
+    if pyramid is None:
+        pyramid = dtm_pyramid(Z_DTM, geotransform)
+
+    # ray directions in object space
+    rays = np.einsum('nij,nj->ni', R[photo], xyf)
+    kx = rays[:, 0] / rays[:, 2]
+    ky = rays[:, 1] / rays[:, 2]
+    Xs = np.asarray(Xs, dtype=float)[photo]
+    Ys = np.asarray(Ys, dtype=float)[photo]
+    Zs = np.asarray(Zs, dtype=float)[photo]
+    Z = np.asarray(Z, dtype=float)[photo]
+
+    XY = np.full((xyf.shape[0], 2), np.nan)
+    ray_iterations = np.zeros(xyf.shape[0], dtype=int)
+
+    def heights(idx, Z_level, geot_level, mode):
+        X, Y = XY[idx, 0], XY[idx, 1]
+        if crs_DTM != crs_pc:
+            X, Y = transf_coord(transformer, X, Y)
+        column, row = crs2pixel(geot_level, X, Y)
+        return ndimage.map_coordinates(Z_level, np.vstack((row, column)),
+                                       output=np.float64, order=1, mode=mode)
+
+    levels = list(pyramid) + [(Z_DTM, geotransform)]
+    for level, (Z_level, geot_level) in enumerate(levels):
+        finest = level == len(levels) - 1
+        if finest:
+            level_threshold, limit, mode = threshold, max_iterations, 'constant'
+        else:
+            # coarse levels only bring rays close to the terrain
+            level_threshold = max(threshold, fabs(geot_level[1]))
+            limit, mode = COARSE_ITERATIONS, 'nearest'
+        if use_numba() and crs_DTM == crs_pc:
+            # compiled loop over rays, heights interpolated the same way
+            iterate_rays(Xs, Ys, Zs, kx, ky, Z, XY, ray_iterations, Z_level,
+                         crs2pixel_params(geot_level), level_threshold,
+                         limit, mode == 'nearest', level > 0, finest)
+            continue
+        active = np.ones(xyf.shape[0], dtype=bool)
+        idx = np.arange(xyf.shape[0])
+        if level > 0:
+            Z[idx] = heights(idx, Z_level, geot_level, mode)
+        counter = 0
+
+        while idx.size:
+            X = Xs[idx] + (Z[idx] - Zs[idx]) * kx[idx]
+            Y = Ys[idx] + (Z[idx] - Zs[idx]) * ky[idx]
+            shift = ((X - XY[idx, 0])**2 + (Y - XY[idx, 1])**2)**0.5
+            XY[idx, 0] = X
+            XY[idx, 1] = Y
+            if finest:
+                ray_iterations[idx] += 1
+            # rays that moved less than threshold are done
+            active[idx[shift < level_threshold]] = False
+
+            # protection against too long iteration
+            if counter > limit:
+                break
+            counter += 1
+
+            idx = np.flatnonzero(active)
+            if not idx.size:
+                break
+            Z[idx] = heights(idx, Z_level, geot_level, mode)
+
+    bounds = np.cumsum(counts)[:-1]
+    iterations = [int(i.max()) if i.size else 0
+                  for i in np.split(ray_iterations, bounds)]
+    return np.split(XY, bounds), iterations
 
 
 def ground_edge_points(R, Z, threshold, xyf, Xs, Ys, Zs,
                        Z_DTM, geotransform, crs_DTM, crs_pc, transformer):
     """Return ground coordinates of points representing edges of photo."""
 
-    XY = np.zeros((xyf.shape[0], 2))
-    XY_prev = np.ones((xyf.shape[0], 2)) * 1000
-    Z = np.ones(xyf.shape[0]) * Z
-    counter = 0
-
-    while not threshold_reached(XY, XY_prev, threshold):
-        XY_prev = np.array(XY)
-
-        X = Xs + (Z - Zs) * np.divide(np.dot(xyf, R[0]), np.dot(xyf, R[2]))
-        Y = Ys + (Z - Zs) * np.divide(np.dot(xyf, R[1]), np.dot(xyf, R[2]))
-        XY = np.column_stack((X, Y))
-
-        if crs_DTM == crs_pc:
-            column, row = crs2pixel(geotransform, X, Y)
-        else:
-            X_DTM, Y_DTM = transf_coord(transformer, X, Y)
-            column, row = crs2pixel(geotransform, X_DTM, Y_DTM)
-
-        rc_array = np.column_stack((row, column)).T
-        Z = ndimage.map_coordinates(Z_DTM, rc_array, output=np.float)
-
-        # protection against too long iteration
-        if counter > 100:
-            break
-        counter += 1
-
-    return XY
+    XY, _ = ground_edge_points_batch([R], [Z], threshold, [xyf], [Xs], [Ys],
+                                     [Zs], Z_DTM, geotransform, crs_DTM,
+                                     crs_pc, transformer)
+    return XY[0]
 
 
 def image_edge_points(camera, Z, Zs, mean_res):
@@ -249,25 +424,317 @@ def image_edge_points(camera, Z, Zs, mean_res):
     return xyf
 
 
-def threshold_reached(xy, xy_previous, threshold):
-    """Check if distance between coordinates from iteration i and i-1
-    is less than given threshold."""
-    dx2_dy2 = (xy - xy_previous)**2
-    d = (dx2_dy2[:, 0] + dx2_dy2[:, 1])**0.5
-    return all(d < threshold)
-
-
-def angle_between_vectors(v1, v2):
-    """Return angle between two 2D vectors."""
-    v1v2 = np.dot(v1, v2)
-    lenv1 = np.linalg.norm(v1)
-    lenv2 = np.linalg.norm(v2, axis=0)
-    # cosine of angle g between vectors
-    g = np.array(v1v2 / (lenv1 * lenv2))
-    g[g > 1] = 1
-    g[g < -1] = -1
-    angle = np.arccos(g) * 180 / pi
-    return angle
+def adaptive_ground_edge_points(R, Z, threshold, tolerance, camera, mean_res,
+                                Xs, Ys, Zs, Z_DTM, geotransform, crs_DTM,
+                                crs_pc, transformer, initial_points=4,
+                                pyramid=None):
+    """Return list of ground coordinates of points representing edges
+    of many photos and number of iterations done for each photo.
+    Edges of image are sampled coarsely first, segment is refined only
+    where its projected ground edge deviates from a straight segment
+    by more than tolerance, but not below one point per DTM cell.
+    DTM pyramid (see dtm_pyramid) is built once for all passes."""
+
+    if pyramid is None:
+        pyramid = dtm_pyramid(Z_DTM, geotransform)
+    f = camera.focal_length
+    x_max = camera.sensor_size * camera.pixels_along_track / 2
+    y_max = camera.sensor_size * camera.pixels_across_track / 2
+    # corners of image in the order of image_edge_points
+    corners = np.array([[-x_max, -y_max], [-x_max, y_max],
+                        [x_max, y_max], [x_max, -y_max]])
+    t = np.tile(np.arange(initial_points) / initial_points, 4).reshape(-1, 1)
+    start = np.repeat(corners, initial_points, axis=0)
+    end = np.repeat(np.roll(corners, -1, axis=0), initial_points, axis=0)
+    ring = start + (end - start) * t
+
+    def with_focal(xy):
+        return np.column_stack((xy, np.full(xy.shape[0], -f)))
+
+    # shortest segment in image space: one DTM cell on the ground
+    min_length = mean_res * f / (np.asarray(Zs) - np.asarray(Z))
+
+    images = [ring.copy() for _ in range(len(R))]
+    grounds, iterations = ground_edge_points_batch(
+        R, Z, threshold, [with_focal(xy) for xy in images], Xs, Ys, Zs,
+        Z_DTM, geotransform, crs_DTM, crs_pc, transformer, pyramid=pyramid)
+    # segments to check, segment i joins point i and i + 1 of the ring
+    todo = [np.arange(ring.shape[0]) for _ in range(len(R))]
+
+    while any(segments.size for segments in todo):
+        mids = []
+        for p, segments in enumerate(todo):
+            a = images[p][segments]
+            b = images[p][(segments + 1) % images[p].shape[0]]
+            long_enough = np.hypot(*(b - a).T) > 2 * min_length[p]
+            todo[p] = segments[long_enough]
+            mids.append((a[long_enough] + b[long_enough]) / 2)
+
+        mids_ground, mids_iterations = ground_edge_points_batch(
+            R, Z, threshold, [with_focal(xy) for xy in mids], Xs, Ys, Zs,
+            Z_DTM, geotransform, crs_DTM, crs_pc, transformer,
+            pyramid=pyramid)
+
+        for p, segments in enumerate(todo):
+            iterations[p] = max(iterations[p], mids_iterations[p])
+            if not segments.size:
+                continue
+            A = grounds[p][segments]
+            B = grounds[p][(segments + 1) % grounds[p].shape[0]]
+            M = mids_ground[p]
+            # distance of projected midpoint from straight ground segment
+            AB = B - A
+            AM = M - A
+            deviation = np.abs(AB[:, 0] * AM[:, 1] - AB[:, 1] * AM[:, 0]) \
+                / np.maximum(np.hypot(AB[:, 0], AB[:, 1]), 1e-12)
+            refine = deviation > tolerance
+
+            positions = segments[refine] + 1
+            images[p] = np.insert(images[p], positions, mids[p][refine], axis=0)
+            grounds[p] = np.insert(grounds[p], positions, M[refine], axis=0)
+            # both halves of every refined segment are checked again
+            inserted = positions + np.arange(positions.size)
+            todo[p] = np.sort(np.concatenate((inserted - 1, inserted)))
+
+    return grounds, iterations
+
+
+def photos_control(dtm, camera, xyf_corners, eo, Z_min, mean_res,
+                   threshold, crs_rst, crs_vct, transf_vct_rst,
+                   raster_outputs=True, edge_tolerance=None, stats=None):
+    """Return list of results for every photo of EO array
+    (X, Y, Z, omega, phi, kappa): footprint vertices and, if raster_outputs
+    is set, GSD array masked by footprint, logical array of footprint
+    and geotransform of both arrays. Footprints of neighbouring photos
+    are calculated together on their common DTM window. If edge_tolerance
+    is given, edges are sampled adaptively instead of one point
+    per DTM cell. Time of stages and counters are added to stats
+    (RunStats) if given."""
+
+    if stats is None:
+        stats = RunStats()
+
+    eo = np.asarray(eo, dtype=float).reshape((-1, 6))
+    R_all = [rotation_matrix(omega, phi, kappa)
+             for omega, phi, kappa in eo[:, 3:]]
+    windows = photos_windows(dtm, xyf_corners, eo, Z_min, transf_vct_rst,
+                             crs_rst, crs_vct, R_all)
+
+    results = []
+    for indices, union in window_groups(windows):
+        c0, r0, c1, r1 = union
+        with stats.stage('dtm_read'):
+            union_DTM = dtm.read(c0, r0, c1 - c0 + 1, r1 - r0 + 1)
+        union_geot = list(dtm.geotransform)
+        union_geot[0], union_geot[3] = pixel2crs(dtm.geotransform, c0, r0)
+
+        Xs, Ys, Zs = eo[indices, 0], eo[indices, 1], eo[indices, 2]
+        R = [R_all[i] for i in indices]
+        if crs_vct != crs_rst:
+            Xs_rast, Ys_rast = transf_coord(transf_vct_rst, Xs, Ys)
+            c, r = crs2pixel(union_geot, Xs_rast, Ys_rast)
+        else:
+            c, r = crs2pixel(union_geot, Xs, Ys)
+
+        # getting Z value from DTM under given center projection points
+        Z_under_pc = ndimage.map_coordinates(union_DTM, np.vstack((r, c)),
+                                             output=np.float64, order=1)
+
+        with stats.stage('ray_iteration'):
+            if edge_tolerance:
+                vertices_list, iterations = adaptive_ground_edge_points(
+                    R, Z_under_pc, threshold, edge_tolerance, camera,
+                    mean_res, Xs, Ys, Zs, union_DTM, union_geot, crs_rst,
+                    crs_vct, transf_vct_rst)
+            else:
+                # edge points lists in image space
+                xyf_list = [image_edge_points(camera, Z_pc, Z_s, mean_res)
+                            for Z_pc, Z_s in zip(Z_under_pc, Zs)]
+
+                # ground coordinates of photos edge points
+                vertices_list, iterations = ground_edge_points_batch(
+                    R, Z_under_pc, threshold, xyf_list, Xs, Ys, Zs,
+                    union_DTM, union_geot, crs_rst, crs_vct, transf_vct_rst)
+        stats.count('photos', len(indices))
+        stats.count('ray_iterations', sum(iterations))
+        stats.maximum('ray_iterations_max', max(iterations))
+        stats.count('iteration_cap_hits',
+                    sum(it > MAX_ITERATIONS for it in iterations))
+
+        for i, footprint_vertices in zip(indices, vertices_list):
+            if not raster_outputs:
+                results.append((footprint_vertices, None, None, None))
+                continue
+            # DTM clipped by bounding box of the photo
+            wc0, wr0, wc1, wr1 = windows[i]
+            clipped_DTM = union_DTM[wr0 - r0:wr1 - r0 + 1,
+                                    wc0 - c0:wc1 - c0 + 1]
+            clipped_geot = list(dtm.geotransform)
+            clipped_geot[0], clipped_geot[3] = pixel2crs(dtm.geotransform,
+                                                         wc0, wr0)
+            with stats.stage('rasterization'):
+                results.append((footprint_vertices,)
+                               + photo_rasters(footprint_vertices, clipped_DTM,
+                                               clipped_geot, camera, R_all[i],
+                                               *eo[i, :3], crs_rst, crs_vct,
+                                               transf_vct_rst))
+    return results
+
+
+def photo_rasters(footprint_vertices, clipped_DTM, clipped_geot, camera, R,
+                  Xs, Ys, Zs, crs_rst, crs_vct, transf_vct_rst):
+    """Return GSD array masked by footprint, logical array of footprint
+    and geotransform of both arrays."""
+
+    vertices_rast = footprint_vertices
+    if crs_vct != crs_rst:
+        X_rast, Y_rast = transf_coord(transf_vct_rst,
+                                      footprint_vertices[:, 0],
+                                      footprint_vertices[:, 1])
+        vertices_rast = np.hstack((X_rast.reshape((-1, 1)),
+                                   Y_rast.reshape((-1, 1))))
+
+    overlap_arr, overlap_geot = overlap_photo(vertices_rast, clipped_geot,
+                                              clipped_DTM.shape)
+
+    deltac = int(fabs(round((clipped_geot[0] - overlap_geot[0]) / overlap_geot[1], 0)))
+    deltar = int(fabs(round((clipped_geot[3] - overlap_geot[3]) / overlap_geot[5], 0)))
+    fitted_DTM = clipped_DTM[deltar:overlap_arr.shape[0]+deltar,
+                             deltac:overlap_arr.shape[1]+deltac]
+
+    gsd_array = gsd(fitted_DTM, overlap_geot, Xs, Ys, Zs, R,
+                    camera.focal_length, camera.sensor_size)
+
+    gsd_masked = np.where(overlap_arr, gsd_array, np.float32(1000))
+
+    return gsd_masked, overlap_arr, overlap_geot
+
+
+def achieved_overlaps(footprint_layer, strips=None):
+    """Return dictionary {feature id: (forward min, forward max,
+    sidelap min, sidelap max)} of achieved overlaps [%] of footprints.
+    Features are expected in the order of flight. Forward overlap is
+    measured with the previous and next photo of the same strip, sidelap
+    with the best matching photo of the nearest flight line on each side
+    across-track (see sidelap_strips), so strips split by gaps in the AoI
+    are handled. Only photos with intersecting bounding boxes found
+    in the spatial index are compared. Sidelap is None if strip numbers
+    are not given."""
+    from qgis.core import QgsSpatialIndex
+
+    feats = list(footprint_layer.getFeatures())
+    index = QgsSpatialIndex(footprint_layer.getFeatures())
+    geometries = {f.id(): f.geometry() for f in feats}
+    order = {f.id(): i for i, f in enumerate(feats)}
+    centroids = np.array([[point.x(), point.y()] for point in
+                          (geometries[f.id()].centroid().asPoint()
+                           for f in feats)]).reshape((-1, 2))
+    if strips is not None:
+        directions = strip_directions(centroids, strips)
+
+    overlaps = {}
+    for i, f in enumerate(feats):
+        geom = geometries[f.id()]
+        area = geom.area()
+        forward = []
+        # photos of other strips, the nearest strips on both sides
+        # across-track are used for sidelap
+        others = {}
+        for fid in index.intersects(geom.boundingBox()):
+            j = order[fid]
+            if j == i or area == 0:
+                continue
+            if strips is None or strips[i] == strips[j]:
+                if abs(i - j) == 1:
+                    forward.append(overlap_ratio(geom, geometries[fid], area))
+            else:
+                others.setdefault(strips[j], []).append(j)
+        side = []
+        if others:
+            for strip in sidelap_strips(i, others, centroids,
+                                        directions.get(strips[i]),
+                                        0.1 * sqrt(area)):
+                ratios = [overlap_ratio(geom, geometries[feats[j].id()], area)
+                          for j in others[strip]]
+                ratios = [ratio for ratio in ratios if ratio is not None]
+                if ratios:
+                    side.append(max(ratios))
+        forward = [ratio for ratio in forward if ratio is not None]
+
+        fwd = (min(forward), max(forward)) if forward else (None, None)
+        sd = (min(side), max(side)) if side else (None, None)
+        overlaps[f.id()] = fwd + sd
+    return overlaps
+
+
+def overlap_ratio(geom, other, area):
+    """Return area of common part of geometries as percentage of area
+    of geom, None if they do not intersect."""
+    common = geom.intersection(other)
+    if common.isEmpty():
+        return None
+    return common.area() / area * 100
+
+
+def strip_directions(centroids, strips):
+    """Return dictionary {strip: unit vector of flight direction} from the
+    first to the last footprint centroid of every strip. Strips with one
+    photo get direction of the first strip having more."""
+    first, last = {}, {}
+    for i, strip in enumerate(strips):
+        first.setdefault(strip, i)
+        last[strip] = i
+    directions = {}
+    for strip in first:
+        vector = centroids[last[strip]] - centroids[first[strip]]
+        length = np.hypot(*vector)
+        if length > 0:
+            directions[strip] = vector / length
+    default = next(iter(directions.values()), None)
+    return {strip: directions.get(strip, default) for strip in first}
+
+
+def sidelap_strips(i, others, centroids, direction, same_line):
+    """Return strips (keys of others: {strip: indices of its photos
+    intersecting photo i}) with flight lines nearest to photo i on both
+    sides across-track. Strips whose photos are closer than same_line
+    across-track continue the flight line of photo i after a gap and are
+    not neighbours. Without direction the nearest strip is returned."""
+    offsets = {}
+    for strip, indices in others.items():
+        shift = centroids[indices].mean(axis=0) - centroids[i]
+        if direction is None:
+            offsets[strip] = np.hypot(*shift)
+        else:
+            # signed distance across-track, positive on the left
+            offsets[strip] = direction[0] * shift[1] - direction[1] * shift[0]
+    left = [(offset, strip) for strip, offset in offsets.items()
+            if offset > same_line]
+    right = [(-offset, strip) for strip, offset in offsets.items()
+             if offset < -same_line]
+    return [min(nearest)[1] for nearest in (left, right) if nearest]
+
+
+def strip_overlaps(overlaps, strips):
+    """Return dictionary {strip: (number of photos, forward min,
+    forward max, sidelap min, sidelap max)} summarizing achieved
+    overlaps (see achieved_overlaps) of photos listed in flight order."""
+
+    def extreme(fn, values):
+        values = [v for v in values if v is not None]
+        return fn(values) if values else None
+
+    summary = {}
+    photos = {}
+    for strip, ovl in zip(strips, overlaps.values()):
+        photos.setdefault(strip, []).append(ovl)
+    for strip, ovl in photos.items():
+        summary[strip] = (len(ovl),
+                          extreme(min, [o[0] for o in ovl]),
+                          extreme(max, [o[1] for o in ovl]),
+                          extreme(min, [o[2] for o in ovl]),
+                          extreme(max, [o[3] for o in ovl]))
+    return summary
 
 
 def bounding_box_at_angle(alpha, geom):
@@ -467,6 +934,9 @@ def projection_centres(alpha, geometry, crs_vect, a_ll, b_ll, a_l_, b_l_,
                        Dx, Dy, Bx, By, Lx, Ly, x, m, H, strip_nr, photo_nr):
     """Create QgsVectorLayer of projection centers with attribute table
     and QgsVectorLayer range of photos at average terrain height."""
+    from PyQt5.QtCore import QVariant
+    from qgis.core import QgsField, QgsGeometry, QgsPointXY, QgsVectorLayer
+
     # Dx, Dy - dimensions of bounding box at angle,
     # respectively along and across of the flight direction
     # Bx, By - longitudinal, transverse base between center projections
@@ -547,100 +1017,133 @@ def projection_centres(alpha, geometry, crs_vect, a_ll, b_ll, a_l_, b_l_,
     d = sqrt((Lx / 2) ** 2 + (Ly / 2) ** 2)
     theta = fabs(atan2(Ly / 2, Lx / 2))
 
-    # calculate projection centers and ground ranges of photos
+    # offsets of photo corners from projection centre
+    corners = np.array([[cos(radians(alpha) + theta - pi) * d,
+                         sin(radians(alpha) + theta - pi) * d],
+                        [cos(radians(alpha) - theta + pi) * d,
+                         sin(radians(alpha) - theta + pi) * d],
+                        [cos(radians(alpha) + theta) * d,
+                         sin(radians(alpha) + theta) * d],
+                        [cos(radians(alpha) - theta) * d,
+                         sin(radians(alpha) - theta) * d]])
+    # candidate photos of strip and first projection centres of strips
+    n = np.arange(-m, Nx - m)
+    x0_strips = np.cumsum(np.r_[x0, np.full(Ny - 1, dx0)])
+    y0_strips = np.cumsum(np.r_[y0, np.full(Ny - 1, dy0)])
+
+    # calculate projection centers and ground ranges of photos,
+    # features are added to layers in bulk
+    pc_wkbs = []
+    pc_attributes = []
+    photo_wkbs = []
+    photo_attributes = []
     for k in range(Ny):
-        n_prev = -m - 1
+        x0, y0 = x0_strips[k], y0_strips[k]
         # coordinates of strip range
-        xs1 = x0 + (-m) * dx + cos(radians(alpha) + theta - pi) * d
-        ys1 = y0 + (-m) * dy + sin(radians(alpha) + theta - pi) * d
-        xs2 = x0 + (-m) * dx + cos(radians(alpha) - theta + pi) * d
-        ys2 = y0 + (-m) * dy + sin(radians(alpha) - theta + pi) * d
-        xe3 = x0 + (Nx - m - 1) * dx + cos(radians(alpha) + theta) * d
-        ye3 = y0 + (Nx - m - 1) * dy + sin(radians(alpha) + theta) * d
-        xe4 = x0 + (Nx - m - 1) * dx + cos(radians(alpha) - theta) * d
-        ye4 = y0 + (Nx - m - 1) * dy + sin(radians(alpha) - theta) * d
+        xs1 = x0 + (-m) * dx + corners[0, 0]
+        ys1 = y0 + (-m) * dy + corners[0, 1]
+        xs2 = x0 + (-m) * dx + corners[1, 0]
+        ys2 = y0 + (-m) * dy + corners[1, 1]
+        xe3 = x0 + (Nx - m - 1) * dx + corners[2, 0]
+        ye3 = y0 + (Nx - m - 1) * dy + corners[2, 1]
+        xe4 = x0 + (Nx - m - 1) * dx + corners[3, 0]
+        ye4 = y0 + (Nx - m - 1) * dy + corners[3, 1]
         strip_pnts = [QgsPointXY(xs1, ys1), QgsPointXY(xs2, ys2),
                       QgsPointXY(xe3, ye3), QgsPointXY(xe4, ye4)]
         geom_strip = QgsGeometry.fromPolygonXY([strip_pnts])
         common_part = geom_strip.intersection(geometry)
 
-        for n in range(-m, Nx - m):
-            xi = x0 + n * dx
-            yi = y0 + n * dy
-            # coordinates of ground photo range
-            x1 = xi + cos(radians(alpha) + theta - pi) * d
-            y1 = yi + sin(radians(alpha) + theta - pi) * d
-            x2 = xi + cos(radians(alpha) - theta + pi) * d
-            y2 = yi + sin(radians(alpha) - theta + pi) * d
-            x3 = xi + cos(radians(alpha) + theta) * d
-            y3 = yi + sin(radians(alpha) + theta) * d
-            x4 = xi + cos(radians(alpha) - theta) * d
-            y4 = yi + sin(radians(alpha) - theta) * d
-            feat_poly = QgsFeature()
-            pnts = [QgsPointXY(x1, y1), QgsPointXY(x2, y2),
-                    QgsPointXY(x3, y3), QgsPointXY(x4, y4)]
-            geom_poly = QgsGeometry.fromPolygonXY([pnts])
-            xp = xi + cos(radians(alpha) + pi / 2) * Ly / 2
-            yp = yi + sin(radians(alpha) + pi / 2) * Ly / 2
-            xk = xi + cos(radians(alpha) - pi / 2) * Ly / 2
-            yk = yi + sin(radians(alpha) - pi / 2) * Ly / 2
-            central_line = QgsGeometry.fromPolylineXY([QgsPointXY(xp, yp),
-                                                       QgsPointXY(xk, yk)])
-            # check if projection centre can be skipped
-            if central_line.distance(common_part) <= m * Bx:
-                photo_nr += 1
-                if fabs(n - n_prev) != 1:
-                    strip_nr += 1
-                s_nr = '%(s_nr)04d' % {'s_nr': strip_nr}
-                p_nr = '%(p_nr)05d' % {'p_nr': photo_nr}
-                n_prev = n
-                feat_pnt = QgsFeature()
-                pnt = QgsPointXY(xi, yi)
-                feat_pnt.setGeometry(QgsGeometry.fromPointXY(pnt))
-                feat_pnt.setAttributes([s_nr, p_nr, round(xi, 2), round(yi, 2),
-                                        round(H, 2), None, 0, 0, kappa])
-                pr.addFeature(feat_pnt)
-                pc_layer.updateExtents()
-                feat_poly.setGeometry(geom_poly)
-                feat_poly.setAttributes([s_nr, p_nr])
-                prov_photos.addFeature(feat_poly)
-                photo_layer.updateExtents()
-
-        # reverse order of numbering photos of odd strips
+        xi = x0 + n * dx
+        yi = y0 + n * dy
+        # check which projection centres can be skipped: central line
+        # of photo is farther than m bases from the strip part of AoI
+        distance = along_track_distance(common_part, x0, y0, alpha, n * Bx)
+        if distance is None:
+            # distance to empty geometry is -1, all photos are kept
+            keep = np.ones(n.size, dtype=bool)
+        else:
+            keep = distance <= m * Bx
+        n_kept, xi, yi = n[keep], xi[keep], yi[keep]
+
+        # new strip number after every gap in the strip
+        n_prev = np.r_[-m - 1, n_kept[:-1]]
+        strip_numbers = (strip_nr + np.cumsum(np.abs(n_kept - n_prev) != 1)).tolist()
+        photo_numbers = (photo_nr + np.arange(1, n_kept.size + 1)).tolist()
+        for s, p, x_pc, y_pc in zip(strip_numbers, photo_numbers,
+                                    xi.tolist(), yi.tolist()):
+            photo_wkbs.append(polygon_wkb(np.array([x_pc, y_pc]) + corners))
+            photo_attributes.append(['%(s_nr)04d' % {'s_nr': s},
+                                     '%(p_nr)05d' % {'p_nr': p}])
+        if n_kept.size:
+            strip_nr = strip_numbers[-1]
+            photo_nr = photo_numbers[-1]
+        # reverse order of numbering projection centres of odd strips
         if k % 2 == 0:
-            first_p = int(p_nr) + 1
-            first_s = int(s_nr) + 1
+            first_p = photo_nr + 1
+            first_s = strip_nr + 1
         else:
-            update_order(k, first_p, first_s, p_nr, s_nr, pc_layer)
-
-        x0 = x0 + dx0
-        y0 = y0 + dy0
+            photo_numbers, strip_numbers = update_order(
+                first_p, first_s, photo_nr, strip_nr, photo_numbers,
+                strip_numbers)
+        for s, p, x_pc, y_pc in zip(strip_numbers, photo_numbers,
+                                    xi.tolist(), yi.tolist()):
+            pc_wkbs.append(point_wkb(x_pc, y_pc))
+            pc_attributes.append(['%(s_nr)04d' % {'s_nr': s},
+                                  '%(p_nr)05d' % {'p_nr': p},
+                                  round(x_pc, 2), round(y_pc, 2),
+                                  round(H, 2), None, 0, 0, kappa])
+
+    add_features(pc_layer, pc_wkbs, pc_attributes)
+    add_features(photo_layer, photo_wkbs, photo_attributes)
     return pc_layer, photo_layer, strip_nr, photo_nr
 
 
-def update_order(k, first_p, first_s, p_nr, s_nr, pc_layer):
-    list_p = list(range(first_p, int(p_nr) + 1))
-    list_s = list(range(first_s, int(s_nr) + 1))
+def along_track_distance(geometry, x0, y0, alpha, u):
+    """Return distances of central lines of photos (perpendicular to flight
+    direction alpha, at positions u along the strip starting at x0, y0)
+    to geometry lying within the strip, None if geometry is empty.
+    Central lines span the whole width of the strip, so the distance
+    to a connected part of geometry is the distance of u to the range
+    of the part along the strip (negative for lines crossing the part)."""
+    if geometry.isNull() or geometry.isEmpty():
+        return None
+    ranges = []
+    for part in geometry.asGeometryCollection():
+        xy = np.array([(v.x(), v.y()) for v in part.vertices()])
+        if xy.size:
+            t = (xy[:, 0] - x0) * cos(radians(alpha)) \
+                + (xy[:, 1] - y0) * sin(radians(alpha))
+            ranges.append((t.min(), t.max()))
+    if not ranges:
+        return None
+    start, end = np.array(ranges).T
+    u = np.asarray(u, dtype=float)[:, None]
+    return np.maximum(start - u, u - end).min(axis=1)
+
+
+def update_order(first_p, first_s, p_nr, s_nr, photo_numbers, strip_numbers):
+    """Return photo and strip numbers of projection centres of a strip
+    flown in the opposite direction (serpentine numbering). Photo numbers
+    first_p...p_nr and strip numbers first_s...s_nr are assigned
+    in reverse order, photo_numbers and strip_numbers are the numbers
+    in the order of generation."""
+    list_p = list(range(first_p, p_nr + 1))
+    list_s = list(range(first_s, s_nr + 1))
+    if not photo_numbers or not list_s:
+        return photo_numbers, strip_numbers
     i = len(list_p) - 1
     j = len(list_s) - 1
     nr_strp_prev = list_s[0]
-    for f in pc_layer.getFeatures():
-        nr_zdj = int(f.attribute('Photo Number'))
-        nr_strp = int(f.attribute('Strip'))
-
-        if nr_zdj in list_p:
-            p_nr = '%(p_nr)05d' % {'p_nr': list_p[i]}
-            i -= 1
-            if nr_strp != nr_strp_prev:
-                j -= 1
-
-            s_nr = '%(s_nr)04d' % {'s_nr': list_s[j]}
-            pc_layer.startEditing()
-            pc_layer.changeAttributeValue(f.id(), 1, p_nr)
-            pc_layer.changeAttributeValue(f.id(), 0, s_nr)
-            pc_layer.commitChanges()
-
-            nr_strp_prev = nr_strp
+    new_photo_numbers = []
+    new_strip_numbers = []
+    for nr_strp in strip_numbers:
+        new_photo_numbers.append(list_p[i])
+        i -= 1
+        if nr_strp != nr_strp_prev:
+            j -= 1
+        new_strip_numbers.append(list_s[j])
+        nr_strp_prev = nr_strp
+    return new_photo_numbers, new_strip_numbers
 
 
 def crs2pixel(geo, x, y):
@@ -660,6 +1163,16 @@ def crs2pixel(geo, x, y):
     return column, row
 
 
+def crs2pixel_params(geo):
+    """Return parameters of crs2pixel (upper left x, y, cosine and sine
+    of rotation, column and row size) as a tuple of floats."""
+    pc = sqrt(geo[1] ** 2 + geo[4] ** 2)
+    pr = sqrt(geo[5] ** 2 + geo[2] ** 2)
+    alpha = acos(geo[1] / pc)
+    return (float(geo[0]), float(geo[3]), cos(alpha), sin(alpha),
+            fabs(pc), fabs(pr))
+
+
 def pixel2crs(geo, c, r):
     """Transform coordinates from pixel to CRS coordinates."""
     upx = geo[0]
@@ -715,32 +1228,172 @@ def rotation_matrix(omega, phi, kappa):
     return R
 
 
+@lru_cache(maxsize=32)
+def get_transformer(crs_from, crs_to):
+    """Return Transformer between two CRS (x, y axis order), shared by
+    all callers asking for the same pair. None if the CRS are the same."""
+    if crs_from == crs_to:
+        return None
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
 def transf_coord(transformer, x, y):
-    """Transform coordinates between two CRS."""
+    """Transform coordinates (scalars or arrays) between two CRS,
+    all points are transformed in one call. Coordinates are returned
+    unchanged if transformer is None."""
+    if transformer is None:
+        return x, y
+    if np.ndim(x) or np.ndim(y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
     x_transformed, y_transformed = transformer.transform(x, y)
     return x_transformed, y_transformed
 
 
-def minmaxheight(vector, raster):
-    """Return max and min value of raster clipped by vector layer."""
-
-    zone_stats = QgsZonalStatistics(vector, raster, 'pre-', 1,
-                                    QgsZonalStatistics.Statistics(
-                                        QgsZonalStatistics.Min |
-                                        QgsZonalStatistics.Max))
-    zone_stats.calculateStatistics(None)
-
-    for f in vector.getFeatures():
-        min_h = f.attribute('pre-min')
-        max_h = f.attribute('pre-max')
-
-    min_idx = vector.fields().lookupField('pre-min')
-    max_idx = vector.fields().lookupField('pre-max')
-    vector.startEditing()
-    vector.deleteAttributes([min_idx, max_idx])
-    vector.commitChanges()
-
-    return min_h, max_h
+def point_wkb(x, y):
+    """Return WKB of point."""
+    return struct.pack('<BIdd', 1, 1, x, y)
+
+
+def polygon_wkb(vertices):
+    """Return WKB of polygon with exterior ring given by array
+    of vertices (n x 2 or more columns), the ring is closed here."""
+    ring = np.empty((vertices.shape[0] + 1, 2), dtype='<f8')
+    ring[:-1] = vertices[:, :2]
+    ring[-1] = ring[0]
+    return struct.pack('<BIII', 1, 3, 1, ring.shape[0]) + ring.tobytes()
+
+
+def add_features(layer, wkbs, attributes=None, batch_size=10000):
+    """Add features with geometries given as WKB (see point_wkb,
+    polygon_wkb) and optional lists of attribute values to layer.
+    Features are added in batches of batch_size, the extent
+    is updated once at the end."""
+    from qgis.core import QgsFeature, QgsGeometry
+
+    provider = layer.dataProvider()
+    fields = layer.fields()
+    features = []
+    for i, wkb in enumerate(wkbs):
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        feature = QgsFeature(fields)
+        feature.setGeometry(geometry)
+        if attributes is not None:
+            feature.setAttributes(attributes[i])
+        features.append(feature)
+        if len(features) >= batch_size:
+            provider.addFeatures(features)
+            features = []
+    if features:
+        provider.addFeatures(features)
+    layer.updateExtents()
+
+
+def polygon_parts(geometry):
+    """Return polygons of QgsGeometry (one for every part of multipart
+    geometry) as lists of rings (arrays of vertices), the exterior ring
+    first. Parts of other types (e.g. lines of intersection) are skipped."""
+    return [[np.array([(p.x(), p.y()) for p in ring]) for ring in rings]
+            for rings in (part.asPolygon()
+                          for part in geometry.asGeometryCollection())
+            if rings]
+
+
+def zonal_statistics(dtm, zones, transformer=None, percentiles=(),
+                     block_pixels=2**24):
+    """Return array with minimum, maximum and given percentiles of DTM
+    heights (one row for every zone). Zone is a list of polygons (see
+    polygon_parts), pixels whose centroids lie inside any of them belong
+    to the zone. Only the window of the zone is read from DTM
+    (DTMTileCache or ArrayDTM), in blocks of rows of block_pixels.
+    Zones smaller than a pixel get heights of pixels under their vertices,
+    zones without valid heights get NaN."""
+
+    stats = np.full((len(zones), 2 + len(percentiles)), np.nan)
+    for i, polygons in enumerate(zones):
+        rings = [ring for polygon in polygons for ring in polygon]
+        if not rings:
+            continue
+        vertices = np.vstack(rings)
+        x, y = vertices[:, 0], vertices[:, 1]
+        if transformer is not None:
+            x, y = transf_coord(transformer, x, y)
+        columns, rows = crs2pixel(dtm.geotransform, np.asarray(x, dtype=float),
+                                  np.asarray(y, dtype=float))
+        first_c, first_r, last_c, last_r = pixel_window(dtm, columns, rows)
+        last_c = min(last_c, dtm.shape[1] - 1)
+        last_r = min(last_r, dtm.shape[0] - 1)
+        n_cols = last_c - first_c + 1
+        if n_cols <= 0 or last_r < first_r:
+            continue
+        # vertices of rings of every polygon in pixels of the window
+        ends = np.cumsum([len(ring) for ring in rings])
+        ring_pixels = list(zip(np.split(columns - first_c, ends[:-1]),
+                               np.split(rows, ends[:-1])))
+        counts = np.cumsum([0] + [len(polygon) for polygon in polygons])
+        polygons = [ring_pixels[counts[k]:counts[k + 1]]
+                    for k in range(len(polygons))]
+
+        values, min_h, max_h, n_pixels = [], np.inf, -np.inf, 0
+        block_rows = max(block_pixels // n_cols, 1)
+        for start in range(first_r, last_r + 1, block_rows):
+            heights = dtm.read(first_c, start, n_cols,
+                               min(block_rows, last_r + 1 - start))
+            mask = np.zeros(heights.shape, dtype=bool)
+            for polygon in polygons:
+                # holes are excluded by even-odd rule
+                part_mask = np.zeros(heights.shape, dtype=bool)
+                for ring_columns, ring_rows in polygon:
+                    ring_mask, c0, r0 = polygon_mask(ring_columns,
+                                                     ring_rows - start,
+                                                     heights.shape)
+                    part_mask[r0:r0 + ring_mask.shape[0],
+                              c0:c0 + ring_mask.shape[1]] ^= ring_mask
+                mask |= part_mask
+            n_pixels += np.count_nonzero(mask)
+            block = valid_heights(heights[mask], dtm.nodata)
+            if block.size:
+                min_h = min(min_h, block.min())
+                max_h = max(max_h, block.max())
+                if percentiles:
+                    values.append(block)
+
+        if n_pixels == 0:
+            # no centroid of pixel inside the zone
+            c = np.floor(columns).astype(int) - first_c
+            r = np.floor(rows).astype(int) - first_r
+            heights = dtm.read(first_c, first_r, n_cols, last_r - first_r + 1)
+            inside = (c >= 0) & (r >= 0) \
+                & (c < heights.shape[1]) & (r < heights.shape[0])
+            block = valid_heights(heights[r[inside], c[inside]], dtm.nodata)
+            if block.size:
+                min_h, max_h = block.min(), block.max()
+                values = [block]
+        if min_h > max_h:
+            continue
+        stats[i, :2] = min_h, max_h
+        if percentiles:
+            stats[i, 2:] = np.percentile(np.concatenate(values), percentiles)
+    return stats
+
+
+def valid_heights(heights, nodata=None):
+    """Return heights without nodata and NaN."""
+    if nodata is not None:
+        heights = heights[heights != nodata]
+    return heights[~np.isnan(heights)]
+
+
+def minmaxheight(vector, dtm, transformer=None):
+    """Return min and max height of DTM (DTMTileCache or ArrayDTM) within
+    polygons of all features of vector layer, coordinates are transformed
+    to DTM CRS with transformer (if given)."""
+
+    polygons = [polygon for f in vector.getFeatures()
+                for polygon in polygon_parts(f.geometry())]
+    min_h, max_h = zonal_statistics(dtm, [polygons], transformer)[0]
+    return float(min_h), float(max_h)
 
 
 def save_error():
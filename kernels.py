@@ -0,0 +1,161 @@
+"""
+Optional Numba-compiled kernels of the hot loops of quality control:
+fixed-point iteration of edge rays, scanline rasterization of footprints
+and GSD of DTM cells. One compiled loop replaces many small NumPy calls
+and their temporary arrays. Kernels are used only with 'numba' backend
+(the default if Numba is installed), the NumPy code in functions.py is
+the reference implementation, see benchmarks/parity.py.
+"""
+
+from math import ceil, floor
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numpy', 'numba')
+
+# backend used by functions.py, see set_backend
+_state = {'backend': 'numba' if numba is not None else 'numpy'}
+
+
+def available_backends():
+    """Return names of backends usable in this Python."""
+    return [name for name in BACKENDS if name != 'numba' or numba is not None]
+
+
+def set_backend(name):
+    """Select backend 'numpy', 'numba' or 'auto' (Numba if installed)
+    and return its name. ValueError is raised if the backend
+    is not available."""
+    if name in (None, '', 'auto'):
+        name = 'numba' if numba is not None else 'numpy'
+    if name not in available_backends():
+        raise ValueError(f"Backend '{name}' is not available, "
+                         f"available backends: {available_backends()}")
+    _state['backend'] = name
+    return name
+
+
+def get_backend():
+    return _state['backend']
+
+
+def use_numba():
+    return _state['backend'] == 'numba'
+
+
+def set_threads(count):
+    """Limit number of threads of parallel kernels, e.g. to one in each
+    of many worker processes."""
+    if numba is not None:
+        numba.set_num_threads(max(1, min(count,
+                                         numba.config.NUMBA_NUM_THREADS)))
+
+
+def _jit(parallel=False):
+    """Compile function with Numba if installed (compiled code is cached
+    on disk), otherwise leave it as plain Python."""
+    if numba is None:
+        return lambda func: func
+    return numba.njit(cache=True, parallel=parallel)
+
+
+prange = numba.prange if numba is not None else range
+
+
+@_jit()
+def bilinear(Z, row, col, nearest):
+    """Return bilinear interpolation of Z at (row, col), the same as
+    scipy.ndimage.map_coordinates with order=1 and mode 'nearest'
+    or 'constant' (0 outside the array)."""
+    rows, cols = Z.shape
+    if nearest:
+        row = min(max(row, 0.0), rows - 1.0)
+        col = min(max(col, 0.0), cols - 1.0)
+    elif not (0.0 <= row <= rows - 1.0 and 0.0 <= col <= cols - 1.0):
+        return 0.0
+    r0 = min(int(floor(row)), max(rows - 2, 0))
+    c0 = min(int(floor(col)), max(cols - 2, 0))
+    r1 = min(r0 + 1, rows - 1)
+    c1 = min(c0 + 1, cols - 1)
+    fr = row - r0
+    fc = col - c0
+    top = (1.0 - fc) * Z[r0, c0] + fc * Z[r0, c1]
+    bottom = (1.0 - fc) * Z[r1, c0] + fc * Z[r1, c1]
+    return (1.0 - fr) * top + fr * bottom
+
+
+@_jit()
+def ray_height(Z_level, pixel, X, Y, nearest):
+    """Return height of DTM level under (X, Y), pixel holds parameters
+    of crs2pixel (see functions.crs2pixel_params)."""
+    upx, upy, cos_a, sin_a, pc, pr = pixel
+    column = (cos_a * (X - upx) + sin_a * (Y - upy)) / pc
+    row = (cos_a * (upy - Y) + sin_a * (X - upx)) / pr
+    return bilinear(Z_level, row, column, nearest)
+
+
+@_jit(parallel=True)
+def iterate_rays(Xs, Ys, Zs, kx, ky, Z, XY, iterations, Z_level, pixel,
+                 threshold, limit, nearest, init, count):
+    """Iterate every ray on one DTM level until it moves less than
+    threshold or 'limit' iterations are exceeded, see
+    functions.ground_edge_points_batch. Z, XY and iterations
+    are updated in place."""
+    for i in prange(Z.shape[0]):
+        if init:
+            Z[i] = ray_height(Z_level, pixel, XY[i, 0], XY[i, 1], nearest)
+        counter = 0
+        while True:
+            X = Xs[i] + (Z[i] - Zs[i]) * kx[i]
+            Y = Ys[i] + (Z[i] - Zs[i]) * ky[i]
+            shift = ((X - XY[i, 0])**2 + (Y - XY[i, 1])**2)**0.5
+            XY[i, 0] = X
+            XY[i, 1] = Y
+            if count:
+                iterations[i] += 1
+            if shift < threshold or counter > limit:
+                break
+            counter += 1
+            Z[i] = ray_height(Z_level, pixel, X, Y, nearest)
+
+
+@_jit(parallel=True)
+def fill_polygon(columns, rows, first_c, first_r, mask):
+    """Set pixels of mask (starting at first_c, first_r), whose centroids
+    lie inside polygon given in pixel coordinates, see
+    functions.polygon_mask."""
+    n_rows, n_cols = mask.shape
+    n = columns.shape[0]
+    for r in prange(n_rows):
+        y = first_r + r + 0.5
+        # crossings of scanline with edges: lo <= y < hi
+        x = np.empty(n)
+        k = 0
+        for e in range(n):
+            r0, c0 = rows[e], columns[e]
+            r1, c1 = rows[(e + 1) % n], columns[(e + 1) % n]
+            if min(r0, r1) <= y < max(r0, r1):
+                x[k] = c0 + (y - r0) * (c1 - c0) / (r1 - r0)
+                k += 1
+        x = np.sort(x[:k])
+        for j in range(0, k - 1, 2):
+            c_in = min(max(ceil(x[j] - 0.5) - first_c, 0), n_cols)
+            c_out = min(max(ceil(x[j + 1] - 0.5) - first_c, 0), n_cols)
+            for c in range(c_in, c_out):
+                mask[r, c] = True
+
+
+@_jit(parallel=True)
+def gsd_cells(DTM, Zs, axis_z, row_part, col_part, scale, out):
+    """Compute float32 GSD of DTM cells into out, see functions.gsd."""
+    for r in prange(DTM.shape[0]):
+        for c in range(DTM.shape[1]):
+            value = (np.float32(DTM[r, c]) - Zs) * axis_z
+            value = value + row_part[r]
+            value = value + col_part[c]
+            out[r, c] = value * scale
@@ -0,0 +1,134 @@
+"""
+Streaming accumulation of overlapping and GSD maps. The output grid is
+sized up front from the predicted DTM windows of all photos, every photo
+is folded into it as soon as it is computed. Grids larger than
+the memory limit are kept in memory-mapped files, only the pages touched
+by photos are loaded and the operating system writes them back.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .functions import crs2pixel, pixel2crs
+
+
+def overlap_dtype(count):
+    """Return the smallest unsigned integer type holding number
+    of overlapping photos up to count."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if count <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def extend_range(pixel_range, r, rows, c, cols):
+    """Return range of pixels [min row, max row, min col, max col]
+    extended by block of rows x cols pixels starting at (r, c)."""
+    if pixel_range is None:
+        return [r, r + rows - 1, c, c + cols - 1]
+    return [min(pixel_range[0], r), max(pixel_range[1], r + rows - 1),
+            min(pixel_range[2], c), max(pixel_range[3], c + cols - 1)]
+
+
+class MosaicAccumulator():
+    """Number of overlapping photos and minimum GSD on the output grid."""
+
+    def __init__(self, geotransform, windows, max_memory=None, directory=None):
+        """Create grid covering all DTM windows (first column, first row,
+        last column, last row) of DTM with given geotransform. Grid
+        needing more than max_memory bytes is kept in files created
+        in directory (system temporary directory by default)."""
+        windows = np.asarray(windows).reshape((-1, 4))
+        c0, r0 = windows[:, 0].min(), windows[:, 1].min()
+        c1, r1 = windows[:, 2].max(), windows[:, 3].max()
+        self.geotransform = list(geotransform)
+        self.geotransform[0], self.geotransform[3] = pixel2crs(geotransform,
+                                                               c0, r0)
+        self.shape = (int(r1 - r0 + 1), int(c1 - c0 + 1))
+        # counts never exceed the number of photos, GSD [cm] needs
+        # no more than float32 precision
+        overlay_dtype = overlap_dtype(len(windows))
+        nbytes = self.shape[0] * self.shape[1] * (overlay_dtype.itemsize + 4)
+        self.directory = None
+        if max_memory is not None and nbytes > max_memory:
+            self.directory = tempfile.mkdtemp(prefix='mosaic_', dir=directory)
+            self.overlay = np.lib.format.open_memmap(
+                os.path.join(self.directory, 'overlay.npy'), mode='w+',
+                dtype=overlay_dtype, shape=self.shape)
+            self.gsd = np.lib.format.open_memmap(
+                os.path.join(self.directory, 'gsd.npy'), mode='w+',
+                dtype=np.float32, shape=self.shape)
+            # new files are filled with zeros, GSD is filled in blocks
+            for start, stop in self.row_blocks(0, self.shape[0]):
+                self.gsd[start:stop] = 1000
+                self.gsd.flush()
+        else:
+            self.overlay = np.zeros(self.shape, dtype=overlay_dtype)
+            self.gsd = np.full(self.shape, 1000, dtype=np.float32)
+        # range of pixels covered by photos [min row, max row, min col, max col]
+        self.covered = None
+        # range of pixels changed since it was reset (e.g. by checkpoint)
+        self.changed = None
+
+    def add(self, gsd_array, overlay_array, geot):
+        """Fold overlapping and GSD array of one photo into the grid."""
+        xres, yres = self.geotransform[1], self.geotransform[5]
+        c, r = crs2pixel(self.geotransform, geot[0] + xres / 2,
+                         geot[3] + yres / 2)
+        c = int(c)
+        r = int(r)
+        rows, cols = overlay_array.shape[0], overlay_array.shape[1]
+
+        self.overlay[r:r+rows, c:c+cols] += overlay_array
+        np.fmin(self.gsd[r:r+rows, c:c+cols], gsd_array,
+                out=self.gsd[r:r+rows, c:c+cols])
+
+        self.covered = extend_range(self.covered, r, rows, c, cols)
+        self.changed = extend_range(self.changed, r, rows, c, cols)
+
+    def row_blocks(self, first, last, block_bytes=64 * 1024**2):
+        """Yield ranges (start, stop) of rows from first to last
+        (exclusive) in blocks of about block_bytes of overlapping
+        and GSD array."""
+        # at most 4 bytes of overlapping and 4 bytes of GSD per pixel
+        step = max(block_bytes // max(self.shape[1] * 8, 1), 1)
+        for start in range(first, last, step):
+            yield start, min(start + step, last)
+
+    def flush(self):
+        """Write changed pages of file-backed grid to disk."""
+        if self.directory is not None:
+            self.overlay.flush()
+            self.gsd.flush()
+
+    def close(self):
+        """Remove files of file-backed grid."""
+        if self.directory is not None:
+            self.overlay = self.gsd = None
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def trimmed(self):
+        """Return geotransform, overlapping and GSD arrays
+        trimmed to the range covered by photos."""
+        r0, r1, c0, c1 = self.covered
+        geo = list(self.geotransform)
+        geo[0], geo[3] = pixel2crs(self.geotransform, c0, r0)
+        return (geo, self.overlay[r0:r1+1, c0:c1+1],
+                self.gsd[r0:r1+1, c0:c1+1])
+
+    def write(self, overlay_band, gsd_band):
+        """Write overlapping and GSD arrays trimmed to the range covered
+        by photos to GDAL bands (either may be None) in blocks of rows,
+        so file-backed grid is never loaded whole."""
+        r0, r1, c0, c1 = self.covered
+        for start, stop in self.row_blocks(r0, r1 + 1):
+            if overlay_band is not None:
+                overlay_band.WriteArray(self.overlay[start:stop, c0:c1+1],
+                                        0, start - r0)
+            if gsd_band is not None:
+                gsd_band.WriteArray(self.gsd[start:stop, c0:c1+1],
+                                    0, start - r0)
@@ -0,0 +1,140 @@
+"""
+Parallel execution of the quality control pass (footprint, overlapping
+and GSD of every photo). Exterior Orientation parameters are split into
+chunks which are distributed across a process pool, the DTM is shared
+with the processes through shared memory instead of being pickled.
+"""
+
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+from .dtm import ArrayDTM
+from .functions import (
+    get_transformer,
+    pack_mask,
+    photos_control,
+    unpack_mask
+)
+from .kernels import set_backend, set_threads
+from .stats import RunStats
+
+# state of worker process, set by _init_process
+_process_state = {}
+
+
+def parallel_available():
+    """Check if parallel control can be used in this Python."""
+    return shared_memory is not None
+
+
+def python_executable():
+    """Return path of Python interpreter for worker processes. Inside QGIS
+    sys.executable may point to QGIS binary instead of Python."""
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    for name in ('python.exe', 'pythonw.exe',
+                 os.path.join('bin', 'python3'), os.path.join('bin', 'python')):
+        candidate = os.path.join(sys.exec_prefix, name)
+        if os.path.isfile(candidate):
+            return candidate
+    return sys.executable
+
+
+def _init_process(shm_name, shape, dtype, geotransform, nodata, offset,
+                  dtm_shape, params):
+    """Attach shared DTM and store parameters common for all photos."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _process_state['shm'] = shm
+    _process_state['dtm'] = ArrayDTM(array, geotransform, nodata, offset,
+                                     dtm_shape)
+    # processes already run in parallel, kernels use one thread each
+    set_backend(params.get('backend'))
+    set_threads(1)
+    params['transf_vct_rst'] = get_transformer(params['crs_vct'],
+                                               params['crs_rst'])
+    _process_state['params'] = params
+
+
+def _control_chunk(eo_chunk):
+    """Return results of photos_control for EO chunk and RunStats
+    of the chunk. Footprint masks are packed to bits to cut the size
+    of results sent back to the main process."""
+    p = _process_state['params']
+    stats = RunStats()
+    results = photos_control(_process_state['dtm'], p['camera'],
+                             p['xyf_corners'], eo_chunk, p['Z_min'],
+                             p['mean_res'], p['threshold'], p['crs_rst'],
+                             p['crs_vct'], p['transf_vct_rst'],
+                             p['raster_outputs'], p['edge_tolerance'], stats)
+    if p['raster_outputs']:
+        results = [(vertices, gsd_masked, pack_mask(overlap_arr), geot)
+                   for vertices, gsd_masked, overlap_arr, geot in results]
+    return results, stats
+
+
+def control_parallel(dtm, window, eo, params, workers, chunk_size,
+                     is_killed, stats=None):
+    """Yield results of photos_control for every row of EO array
+    (X, Y, Z, omega, phi, kappa) in the input order, computed in
+    'workers' processes, 'chunk_size' photos at once. Only the window
+    (first column, first row, last column, last row) of DTM covering
+    all photos is put in shared memory. Statistics of processes
+    are merged into stats (RunStats) if given, their stage times
+    are summed process time (see RunStats.merge)."""
+    if stats is None:
+        stats = RunStats()
+    c0, r0, c1, r1 = [int(i) for i in window]
+    with stats.stage('dtm_read'):
+        dtm_array = dtm.read(c0, r0, c1 - c0 + 1, r1 - r0 + 1)
+    shm = shared_memory.SharedMemory(create=True, size=max(dtm_array.nbytes, 1))
+    try:
+        shared_dtm = np.ndarray(dtm_array.shape, dtype=dtm_array.dtype,
+                                buffer=shm.buf)
+        shared_dtm[:] = dtm_array
+        shape, dtype = dtm_array.shape, dtm_array.dtype
+        # release buffer export, so shared memory can be closed later
+        del shared_dtm, dtm_array
+
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(python_executable())
+        chunks = (eo[start:start + chunk_size]
+                  for start in range(0, eo.shape[0], chunk_size))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_process,
+                                 initargs=(shm.name, shape, dtype,
+                                           dtm.geotransform,
+                                           dtm.nodata, (c0, r0), dtm.shape,
+                                           params)) as executor:
+            # keep limited number of chunks in flight to bound memory
+            pending = [executor.submit(_control_chunk, chunk)
+                       for _, chunk in zip(range(2 * workers), chunks)]
+            try:
+                while pending and not is_killed():
+                    results, chunk_stats = pending.pop(0).result()
+                    stats.merge(chunk_stats)
+                    next_chunk = next(chunks, None)
+                    if next_chunk is not None:
+                        pending.append(executor.submit(_control_chunk,
+                                                       next_chunk))
+                    for vertices, gsd_masked, overlap_arr, geot in results:
+                        if overlap_arr is not None:
+                            overlap_arr = unpack_mask(*overlap_arr)
+                        yield vertices, gsd_masked, overlap_arr, geot
+            finally:
+                # stopped or consumer has finished early
+                for future in pending:
+                    future.cancel()
+    finally:
+        shm.close()
+        shm.unlink()
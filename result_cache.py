@@ -0,0 +1,154 @@
+"""
+Persistent cache of quality control results of single photos. Results
+(footprint vertices, GSD and overlapping arrays) are saved on disk under
+a hash of everything they depend on, so reruns after editing a few photos
+compute only the changed ones. Least recently used entries are removed
+when the cache exceeds its size.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from .functions import pack_mask, unpack_mask
+
+
+def dtm_fingerprint(raster):
+    """Return string identifying content of GDAL dataset: path, size
+    and modification time of the file, geotransform and raster size."""
+    path = raster.GetDescription()
+    try:
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    except (OSError, TypeError, ValueError):
+        file_id = (path,)
+    return repr((file_id, tuple(raster.GetGeoTransform()),
+                 raster.RasterXSize, raster.RasterYSize))
+
+
+def photo_key(eo_row, window, common):
+    """Return hash of photo's Exterior Orientation parameters
+    (X, Y, Z, omega, phi, kappa), its DTM window and parameters
+    common for all photos (camera, threshold, DTM fingerprint...)."""
+    key = hashlib.sha1()
+    key.update(np.asarray(eo_row, dtype=np.float64).tobytes())
+    key.update(np.asarray(window, dtype=np.int64).tobytes())
+    key.update(repr(common).encode('utf-8'))
+    return key.hexdigest()
+
+
+class ResultCache():
+    """Directory of results of photos_control, one .npz file per photo."""
+
+    def __init__(self, directory, max_bytes=1024**3):
+        """OSError is raised if directory can not be created."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # entries used in this run are never evicted
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def touch(self, key):
+        """Mark entry as recently used, return False if it does not exist."""
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            return False
+        self.used.add(key)
+        return True
+
+    def get(self, key):
+        """Return cached result (footprint vertices, GSD array, overlapping
+        array, geotransform) or None if it can not be read."""
+        try:
+            with np.load(self.path(key)) as data:
+                if 'gsd' in data:
+                    overlap_arr = unpack_mask(data['overlap_bits'],
+                                              int(data['overlap_cols']))
+                    result = (data['vertices'], data['gsd'],
+                              overlap_arr, list(data['geot']))
+                else:
+                    result = (data['vertices'], None, None, None)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Save result of one photo."""
+        vertices, gsd_masked, overlap_arr, overlap_geot = result
+        arrays = {'vertices': vertices}
+        if gsd_masked is not None:
+            # footprint masks are stored packed to bits
+            overlap_bits, overlap_cols = pack_mask(overlap_arr)
+            arrays.update(gsd=gsd_masked.astype(np.float32, copy=False),
+                          overlap_bits=overlap_bits, overlap_cols=overlap_cols,
+                          geot=np.asarray(overlap_geot, dtype=np.float64))
+        # write to temporary file first, so readers never see partial entry,
+        # result which can not be saved (e.g. full disk) is only not cached
+        tmp_path = self.path(key) + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                np.savez(tmp_file, **arrays)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            return
+        self.used.add(key)
+
+    def evict(self):
+        """Remove least recently used entries above size of the cache."""
+        entries = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith('.npz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            if entry.name[:-4] in self.used:
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            total -= size
+
+    def results(self, keys, compute):
+        """Yield results of all photos given by keys in their order.
+        Cached results are read from the cache, the rest is taken from
+        generator compute(indices of missing photos) and saved."""
+        missing = [i for i, key in enumerate(keys) if not self.touch(key)]
+        self.misses += len(missing)
+        computed = compute(missing)
+        missing = set(missing)
+        try:
+            for i, key in enumerate(keys):
+                if i not in missing:
+                    result = self.get(key)
+                    if result is None:
+                        # damaged entry, compute it again
+                        recomputed = compute([i])
+                        result = next(recomputed)
+                        recomputed.close()
+                        self.put(key, result)
+                else:
+                    result = next(computed, None)
+                    if result is None:
+                        # computation was stopped
+                        return
+                    self.put(key, result)
+                yield result
+        finally:
+            computed.close()
+            self.evict()
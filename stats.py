@@ -0,0 +1,87 @@
+"""
+Run statistics: wall-clock time of stages and counters of a control run.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+
+
+class RunStats():
+    """Time spent in named stages and counters of a run, info holds
+    settings the run used (e.g. backend of kernels)."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        # time of stages in worker processes, summed over all processes
+        # (it may exceed the wall-clock time of the run)
+        self.process_stages = {}
+        self.info = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager adding time of its block to stage 'name'."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def maximum(self, name, value):
+        self.counters[name] = max(self.counters.get(name, value), value)
+
+    def merge(self, other):
+        """Add stages and counters of RunStats returned by a worker process.
+        Its stages run in parallel with others, so their time is added
+        to process_stages, not to wall-clock stages."""
+        for stages in (other.stages, other.process_stages):
+            for name, seconds in stages.items():
+                self.process_stages[name] = \
+                    self.process_stages.get(name, 0.0) + seconds
+        for name, value in other.counters.items():
+            if name.endswith('_max'):
+                self.maximum(name, value)
+            else:
+                self.count(name, value)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def eta(self, done, total):
+        """Return estimated time [s] to process remaining items, based
+        on the rate measured so far, None if nothing is done yet."""
+        if done <= 0:
+            return None
+        return self.elapsed() / done * (total - done)
+
+    def report(self, done=None, total=None):
+        """Return dictionary with all statistics."""
+        report = {'elapsed_s': round(self.elapsed(), 3),
+                  'stages_s': {name: round(seconds, 3)
+                               for name, seconds in self.stages.items()},
+                  'process_stages_s': {name: round(seconds, 3)
+                                       for name, seconds
+                                       in self.process_stages.items()},
+                  'counters': dict(self.counters),
+                  'info': dict(self.info)}
+        if done is not None and total is not None:
+            eta = self.eta(done, total)
+            report['done'] = done
+            report['total'] = total
+            report['eta_s'] = None if eta is None else round(eta, 1)
+        return report
+
+    def save(self, path, **extra):
+        """Save report with extra items as JSON file."""
+        report = self.report()
+        report.update(extra)
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
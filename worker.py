@@ -1,23 +1,22 @@
 import os
+import time
 import traceback
 from math import (
-    ceil,
     cos,
     fabs,
     pi,
     sin
 )
 
-import scipy.ndimage as ndimage
 import numpy as np
-from osgeo import gdal, osr
-from pyproj import Transformer
-from PyQt5.QtCore import pyqtSignal, QObject
+from osgeo import gdal, gdal_array, osr
+from PyQt5.QtCore import pyqtSignal, QObject, QVariant
 from PyQt5.QtGui import QColor
 from qgis.core import (
     QgsColorRampShader,
     QgsCoordinateReferenceSystem,
     QgsFeature,
+    QgsField,
     QgsGeometry,
     QgsPointXY,
     QgsProcessingUtils,
@@ -28,18 +27,29 @@ from qgis.core import (
     QgsVectorLayer,
 )
 
+from .checkpoint import Checkpoint, run_key
+from .dtm import DTMTileCache, sample_heights
+from .kernels import set_backend
 from .functions import (
-    ground_edge_points,
-    image_edge_points,
-    crs2pixel,
-    rotation_matrix,
+    achieved_overlaps,
+    strip_overlaps,
+    get_transformer,
     transf_coord,
-    minmaxheight,
+    polygon_parts,
+    zonal_statistics,
     save_error,
-    clip_raster,
-    overlap_photo,
-    gsd
+    photos_control,
+    photos_windows,
+    add_features,
+    polygon_wkb
 )
+from .mosaic import MosaicAccumulator
+from .parallel import control_parallel, parallel_available
+from .result_cache import ResultCache, dtm_fingerprint, photo_key
+from .stats import RunStats
+
+# number of footprints added to the layer at once
+FEATURE_BATCH = 1000
 
 
 class Worker(QObject):
@@ -48,6 +58,8 @@ class Worker(QObject):
     finished = pyqtSignal(object)
     error = pyqtSignal(Exception, basestring)
     progress = pyqtSignal(float)
+    stats = pyqtSignal(object)
+    message = pyqtSignal(str)
     enabled = pyqtSignal(bool)
 
     def __init__(self, **data):
@@ -78,212 +90,253 @@ class Worker(QObject):
         self.tab_widg_cor = data.get('tabWidg')
         self.g_line_list = data.get('LineRangeList')
         self.geom_aoi = data.get('Range')
+        self.workers = data.get('workers', 1)
+        self.chunk_size = data.get('chunkSize', 64)
+        self.edge_tolerance = data.get('edgeTolerance')
+        self.tile_size = data.get('tileSize', 512)
+        self.cache_size = data.get('cacheSize', 256 * 1024**2)
+        self.result_cache = data.get('resultCache')
+        self.result_cache_size = data.get('resultCacheSize', 1024**3)
+        self.checkpoint_dir = data.get('checkpointDir')
+        self.checkpoint_interval = data.get('checkpointInterval', 60)
+        self.mosaic_memory = data.get('mosaicMemory', 2 * 1024**3)
+        # 'numpy', 'numba' or 'auto' (see kernels.set_backend)
+        self.backend = data.get('backend', 'auto')
+        self.dtm_cache = None
+        self.run_stats = None
+        self.report_path = None
         self.killed = False
 
     def run_control(self):
         """Do the main work for control methods."""
         result = []
+        self.run_stats = RunStats()
         try:
-
-            if self.crs_rst != self.crs_vct:
-                transf_vct_rst = Transformer.from_crs(self.crs_vct,
-                                                      self.crs_rst,
-                                                      always_xy=True)
-                transf_rst_vct = Transformer.from_crs(self.crs_rst,
-                                                      self.crs_vct,
-                                                      always_xy=True)
-            else:
-                transf_vct_rst = None
-                transf_rst_vct = None
-
-            Z_srtm = self.raster.GetRasterBand(1).ReadAsArray()
-            nodata = self.raster.GetRasterBand(1).GetNoDataValue()
-            rst_array = np.ma.masked_equal(Z_srtm, nodata)
-            Z_min = np.nanmin(rst_array)
+            try:
+                self.backend = set_backend(self.backend)
+            except ValueError as e:
+                self.message.emit(f'{e}, NumPy backend is used.')
+                self.backend = set_backend('numpy')
+            self.run_stats.info['backend'] = self.backend
+
+            transf_vct_rst = get_transformer(self.crs_vct, self.crs_rst)
+            transf_rst_vct = get_transformer(self.crs_rst, self.crs_vct)
+
+            # windowed access to DTM, counters are available in
+            # self.dtm_cache.stats() after the run
+            self.dtm_cache = DTMTileCache(self.raster, self.tile_size,
+                                          self.cache_size)
+            Z_min, _ = self.dtm_cache.minmax()
 
             uplx_r, xres_r, xskew_r, \
             uply_r, yskew_r, yres_r = self.raster.GetGeoTransform()
 
             # calculating metric resolution if crs is geographic
             if QgsCoordinateReferenceSystem(self.crs_rst).isGeographic():
-                uplx_r_n = uplx_r + xres_r
-                uply_r_n = uply_r + yres_r
-                uplx_v, uply_v = transf_coord(transf_rst_vct, uplx_r, uply_r)
-                uplx_v_n, uply_v_n = transf_coord(transf_rst_vct, uplx_r_n, uply_r_n)
-                xres_r = fabs(uplx_v_n - uplx_v)
-                yres_r = fabs(uply_v_n - uply_v)
+                # upper left corner of raster and of its first pixel
+                x_v, y_v = transf_coord(transf_rst_vct,
+                                        [uplx_r, uplx_r + xres_r],
+                                        [uply_r, uply_r + yres_r])
+                xres_r = fabs(x_v[1] - x_v[0])
+                yres_r = fabs(y_v[1] - y_v[0])
             mean_res = (fabs(xres_r) + fabs(yres_r)) / 2
 
             # output footprint layer
             footprint_lay = QgsVectorLayer("Polygon?crs=" + str(self.crs_vct),
                                            "footprint", "memory")
             provider = footprint_lay.dataProvider()
-            features = self.layer.getFeatures()
-            feat_footprint = QgsFeature()
-            ds_list = []
-            ulx_list = []
-            uly_list = []
-            lrx_list = []
-            lry_list = []
+            provider.addAttributes([QgsField("Forward min [%]", QVariant.Double),
+                                    QgsField("Forward max [%]", QVariant.Double),
+                                    QgsField("Sidelap min [%]", QVariant.Double),
+                                    QgsField("Sidelap max [%]", QVariant.Double)])
+            footprint_lay.updateFields()
 
             xyf_corners = self.camera.image_corners()
+            raster_outputs = self.overlap_bool or self.gsd_bool
+
+            with self.run_stats.stage('eo_parameters'):
+                eo = self.eo_parameters(transf_vct_rst)
+            feat_count = eo.shape[0]
+            # DTM windows of all photos predict the range of output rasters
+            with self.run_stats.stage('windows'):
+                windows = photos_windows(self.dtm_cache, xyf_corners, eo,
+                                         Z_min, transf_vct_rst, self.crs_rst,
+                                         self.crs_vct)
+            if raster_outputs:
+                # grid larger than mosaicMemory is kept on disk
+                mosaic = MosaicAccumulator(self.dtm_cache.geotransform,
+                                           windows, self.mosaic_memory,
+                                           QgsProcessingUtils.tempFolder())
+
+            def compute(indices):
+                """Yield results of photos given by indices."""
+                if not len(indices):
+                    return
+                eo_part = eo[indices]
+                if self.workers > 1 and parallel_available():
+                    params = {'camera': self.camera,
+                              'xyf_corners': xyf_corners,
+                              'Z_min': Z_min,
+                              'mean_res': mean_res,
+                              'threshold': self.threshold,
+                              'crs_rst': self.crs_rst,
+                              'crs_vct': self.crs_vct,
+                              'raster_outputs': raster_outputs,
+                              'edge_tolerance': self.edge_tolerance,
+                              'backend': self.backend}
+                    w = windows[indices]
+                    union = (w[:, 0].min(), w[:, 1].min(),
+                             w[:, 2].max(), w[:, 3].max())
+                    yield from control_parallel(self.dtm_cache, union,
+                                                eo_part, params,
+                                                self.workers, self.chunk_size,
+                                                lambda: self.killed,
+                                                self.run_stats)
+                else:
+                    # the same chunks as in parallel mode give the same results
+                    for start in range(0, len(indices), self.chunk_size):
+                        yield from photos_control(
+                            self.dtm_cache, self.camera, xyf_corners,
+                            eo_part[start:start + self.chunk_size], Z_min,
+                            mean_res, self.threshold, self.crs_rst,
+                            self.crs_vct, transf_vct_rst, raster_outputs,
+                            self.edge_tolerance, self.run_stats)
+
+            # everything except EO and windows the results depend on
+            common = (vars(self.camera), self.threshold, mean_res,
+                      Z_min, self.edge_tolerance, raster_outputs,
+                      self.crs_rst, self.crs_vct,
+                      dtm_fingerprint(self.raster))
+
+            # resume from the checkpoint of interrupted run
+            done = 0
+            if self.checkpoint_dir:
+                checkpoint = Checkpoint(self.checkpoint_dir,
+                                        run_key(eo, windows, common),
+                                        self.checkpoint_interval)
+                done, footprints = checkpoint.load(
+                    mosaic if raster_outputs else None)
+                add_features(footprint_lay,
+                             [polygon_wkb(vertices) for vertices in footprints])
+                self.run_stats.count('photos_resumed', done)
+                if done:
+                    self.message.emit(f'Run resumed from checkpoint '
+                                      f'{checkpoint.directory}: {done} of '
+                                      f'{feat_count} photos were done by '
+                                      f'an interrupted run.')
+            else:
+                checkpoint = None
+            remaining = np.arange(done, feat_count)
+
+            cache = None
+            if self.result_cache:
+                try:
+                    cache = ResultCache(self.result_cache,
+                                        self.result_cache_size)
+                except OSError as e:
+                    self.message.emit(f'Result cache {self.result_cache} '
+                                      f'can not be used ({e}), all photos '
+                                      f'are computed.')
+            if cache is not None:
+                # unchanged photos are read from results of previous runs
+                keys = [photo_key(eo[i], windows[i], common)
+                        for i in remaining]
+                results = cache.results(
+                    keys, lambda indices: compute(remaining[indices]))
+            else:
+                results = compute(remaining)
 
-            feat_count = self.layer.featureCount()
-            progress_c = 0
+            progress_c = done
+            new_footprints = []
+            # footprints are added to the layer in batches
+            footprint_wkbs = []
             step = feat_count // 1000
-            # creating footprint, overlapping, GSD maps
-            for feature in features:
+            # creating footprint, overlapping, GSD maps, time spent
+            # on waiting for results is the rest of 'control_pass'
+            control_start = time.perf_counter()
+            for footprint_vertices, gsd_masked, overlap_arr, overlap_geot in results:
                 if self.killed is True:
                     # kill request received, exit loop early
                     break
 
-                Xs = feature.geometry().asPoint().x()
-                Ys = feature.geometry().asPoint().y()
-                Zs = feature.attribute(self.height_f)
-                if not self.height_is_ASL:
-                    x, y = Xs, Ys
-                    if self.crs_rst != self.crs_vct:
-                        x, y = transf_coord(transf_vct_rst, Xs, Ys)
-                    terrain_height, res = self.DTM.dataProvider().sample(QgsPointXY(x, y,), 1)
-                    Zs = feature.attribute(self.height_f) + terrain_height
-
-                omega = feature.attribute(self.omega_f)
-                phi = feature.attribute(self.phi_f)
-                kappa = feature.attribute(self.kappa_f)
-
-                R = rotation_matrix(omega, phi, kappa)
-                clipped_DTM, clipped_geot = clip_raster(self.raster, xyf_corners,
-                                                        R, Xs, Ys, Zs, Z_min,
-                                                        transf_vct_rst,
-                                                        self.crs_rst,
-                                                        self.crs_vct)
-
-                if self.crs_vct != self.crs_rst:
-                    Xs_rast, Ys_rast = transf_coord(transf_vct_rst, Xs, Ys)
-                    c, r = crs2pixel(clipped_geot, Xs_rast, Ys_rast)
-                else:
-                    c, r = crs2pixel(clipped_geot, Xs, Ys)
-
-                # getting Z value from DTM under given center projection point
-                Z_under_pc = ndimage.map_coordinates(clipped_DTM,
-                                                     np.array([[r, c]]).T)[0]
-
-                # edge points list in image space
-                xyf = image_edge_points(self.camera, Z_under_pc, Zs, mean_res)
-
-                # ground coordinates of photo edge points
-                footprint_vertices = ground_edge_points(R, Z_under_pc,
-                                                        self.threshold, xyf, Xs,
-                                                        Ys, Zs, clipped_DTM,
-                                                        clipped_geot,
-                                                        self.crs_rst,
-                                                        self.crs_vct,
-                                                        transf_vct_rst)
-
-                footprint_pnts = [QgsPointXY(XY[0], XY[1]) for XY in footprint_vertices]
-                geom_footprint = QgsGeometry.fromPolygonXY([footprint_pnts])
-                feat_footprint.setGeometry(geom_footprint)
-                provider.addFeatures([feat_footprint])
-                footprint_lay.updateExtents()
-
-                if self.overlap_bool or self.gsd_bool:
-                    if self.crs_vct != self.crs_rst:
-                        X_rast, Y_rast = transf_coord(transf_vct_rst,
-                                                      footprint_vertices[:, 0],
-                                                      footprint_vertices[:, 1])
-                        footprint_vertices = np.hstack((X_rast.reshape((-1, 1)),
-                                                        Y_rast.reshape((-1, 1))))
-
-                    overlap_arr, overlap_geot = overlap_photo(footprint_vertices,
-                                                              clipped_geot,
-                                                              clipped_DTM.shape)
-
-                    deltac = int(fabs(round((clipped_geot[0] - overlap_geot[0]) / overlap_geot[1], 0)))
-                    deltar = int(fabs(round((clipped_geot[3] - overlap_geot[3]) / overlap_geot[5], 0)))
-                    fitted_DTM = clipped_DTM[deltar:overlap_arr.shape[0]+deltar, deltac:overlap_arr.shape[1]+deltac]
-
-                    projection_center = np.array([[Xs], [Ys], [Zs]])
-                    img_coords = np.array([[0], [0], [-self.camera.focal_length]])
-                    image_crs = np.add(projection_center,
-                                       np.dot(R, img_coords))
-                    X = image_crs[0][0]
-                    Y = image_crs[1][0]
-                    Z = image_crs[2][0]
-
-                    gsd_array = gsd(fitted_DTM, overlap_geot, Xs, Ys, Zs, X, Y,
-                                    Z, self.camera.focal_length, self.camera.sensor_size)
-
-                    gsd_masked = gsd_array * overlap_arr
-                    gsd_masked = np.where(gsd_masked == 0, 1000, gsd_masked)
-
-                    ds_list.append([gsd_masked, overlap_arr, overlap_geot])
-                    upx, xres, xskew, upy, yskew, yres = overlap_geot
-                    cols = overlap_arr.shape[1]
-                    rows = overlap_arr.shape[0]
-                    ulx = upx  # upper left x
-                    uly = upy  # upper left y
-                    lrx = upx + cols * xres + rows * xskew  # lower right x
-                    lry = upy + cols * yskew + rows * yres  # lower right y
-                    ulx_list.append(ulx)
-                    uly_list.append(uly)
-                    lrx_list.append(lrx)
-                    lry_list.append(lry)
+                with self.run_stats.stage('footprints'):
+                    footprint_wkbs.append(polygon_wkb(footprint_vertices))
+                    if len(footprint_wkbs) >= FEATURE_BATCH:
+                        add_features(footprint_lay, footprint_wkbs)
+                        footprint_wkbs = []
+
+                if raster_outputs:
+                    with self.run_stats.stage('mosaic'):
+                        mosaic.add(gsd_masked, overlap_arr, overlap_geot)
 
                 progress_c += 1
+                if checkpoint is not None:
+                    new_footprints.append(footprint_vertices)
+                    if checkpoint.due():
+                        if not self.save_checkpoint(
+                                checkpoint, progress_c, new_footprints,
+                                mosaic if raster_outputs else None):
+                            checkpoint = None
+                        new_footprints = []
                 if step == 0 or progress_c % step == 0:
                     self.progress.emit(progress_c / float(feat_count) * 100)
+                    self.stats.emit(self.run_stats.report(progress_c - done,
+                                                          feat_count - done))
+            # stop worker processes if loop was interrupted
+            results.close()
+            with self.run_stats.stage('footprints'):
+                add_features(footprint_lay, footprint_wkbs)
+            self.run_stats.add_time('control_pass',
+                                    time.perf_counter() - control_start)
+            self.run_stats.count('photos_processed', progress_c - done)
+            if checkpoint is not None:
+                if progress_c < feat_count:
+                    # stopped, the next run continues from here
+                    self.save_checkpoint(checkpoint, progress_c,
+                                         new_footprints,
+                                         mosaic if raster_outputs else None)
+                else:
+                    checkpoint.remove()
+            if cache is not None:
+                self.run_stats.count('photos_cached', cache.hits)
 
-            if self.overlap_bool or self.gsd_bool:
+            if raster_outputs and mosaic.covered is not None:
                 # range of output raster of 'overlap' and 'gsd' maps
-                ulx_fp = min(ulx_list)
-                uly_fp = max(uly_list)
-                lrx_fp = max(lrx_list)
-                lry_fp = min(lry_list)
-                cols_fp = int(ceil((lrx_fp - ulx_fp) / xres))
-                rows_fp = int(ceil((lry_fp - uly_fp) / yres))
-                final_overlay = np.zeros((rows_fp, cols_fp))
-                final_gsd = np.ones((rows_fp, cols_fp)) * 1000
-                geo = [ulx_fp, xres, xskew, uly_fp, yskew, yres]
-                ds_count = len(ds_list)
-                progress_c = 0
-                step = ds_count // 1000
-                # combining the results of all photos
-                for gsd_array, overlay_array, geot in ds_list:
-                    c, r = crs2pixel(geo, geot[0] + xres / 2,
-                                     geot[3] + yres / 2)
-                    c = int(c)
-                    r = int(r)
-                    rows, cols = overlay_array.shape[0], overlay_array.shape[1]
-
-                    final_overlay[r:r+rows, c:c+cols] = final_overlay[r:r+rows, c:c+cols] + overlay_array
-                    final_gsd[r:r+rows, c:c+cols] = np.where(gsd_array < final_gsd[r:r+rows, c:c+cols], gsd_array, final_gsd[r:r+rows, c:c+cols])
-
-                    progress_c += 1
-                    if step == 0 or progress_c % step == 0:
-                        self.progress.emit(progress_c / float(ds_count) * 100)
-                # saving outputs in temporary folder
-                tmp_overlay = os.path.join(QgsProcessingUtils.tempFolder(), 'overlay.tif')
-                temp_gsd = os.path.join(QgsProcessingUtils.tempFolder(), 'gsd.tif')
-                driver = gdal.GetDriverByName('GTiff')
-                ds_overlay = driver.Create(tmp_overlay, xsize=cols_fp,
-                                           ysize=rows_fp, bands=1,
-                                           eType=gdal.GDT_Float32)
-                ds_gsd = driver.Create(temp_gsd, xsize=cols_fp, ysize=rows_fp,
-                                     bands=1, eType=gdal.GDT_Float32)
-                ds_overlay.GetRasterBand(1).WriteArray(final_overlay)
-                ds_overlay.GetRasterBand(1).SetNoDataValue(0)
-                ds_gsd.GetRasterBand(1).WriteArray(final_gsd)
-                ds_gsd.GetRasterBand(1).SetNoDataValue(1000)
-                # setting CRS of the outputs
-                ds_overlay.SetGeoTransform(geo)
-                ds_gsd.SetGeoTransform(geo)
-                srs = osr.SpatialReference()
-                srs.ImportFromEPSG(int(self.crs_rst.split(":")[1]))
-                srs.SetWellKnownGeogCS(self.crs_rst)
-                ds_overlay.SetProjection(srs.ExportToWkt())
-                ds_gsd.SetProjection(srs.ExportToWkt())
-                ds_overlay = None
-                ds_gsd = None
+                geo, final_overlay, final_gsd = mosaic.trimmed()
+                mosaic.flush()
+                rows_fp, cols_fp = final_overlay.shape
+                with self.run_stats.stage('geotiff_write'):
+                    # saving outputs in temporary folder
+                    tmp_overlay = os.path.join(QgsProcessingUtils.tempFolder(), 'overlay.tif')
+                    temp_gsd = os.path.join(QgsProcessingUtils.tempFolder(), 'gsd.tif')
+                    driver = gdal.GetDriverByName('GTiff')
+                    # data types of the outputs follow the mosaic arrays
+                    # (unsigned integer counts, Float32 GSD), tiled
+                    # BigTIFF is used when the outputs need it
+                    options = ['TILED=YES', 'BIGTIFF=IF_SAFER']
+                    ds_overlay = driver.Create(
+                        tmp_overlay, xsize=cols_fp, ysize=rows_fp, bands=1,
+                        eType=gdal_array.NumericTypeCodeToGDALTypeCode(
+                            final_overlay.dtype), options=options)
+                    ds_gsd = driver.Create(
+                        temp_gsd, xsize=cols_fp, ysize=rows_fp, bands=1,
+                        eType=gdal_array.NumericTypeCodeToGDALTypeCode(
+                            final_gsd.dtype), options=options)
+                    mosaic.write(ds_overlay.GetRasterBand(1),
+                                 ds_gsd.GetRasterBand(1))
+                    ds_overlay.GetRasterBand(1).SetNoDataValue(0)
+                    ds_gsd.GetRasterBand(1).SetNoDataValue(1000)
+                    # setting CRS of the outputs
+                    ds_overlay.SetGeoTransform(geo)
+                    ds_gsd.SetGeoTransform(geo)
+                    srs = osr.SpatialReference()
+                    srs.ImportFromEPSG(int(self.crs_rst.split(":")[1]))
+                    srs.SetWellKnownGeogCS(self.crs_rst)
+                    ds_overlay.SetProjection(srs.ExportToWkt())
+                    ds_gsd.SetProjection(srs.ExportToWkt())
+                    ds_overlay = None
+                    ds_gsd = None
+                self.run_stats.count('output_pixels', 2 * rows_fp * cols_fp)
                 # changing 'logical sum of overlapping images' layer style
                 if self.overlap_bool:
                     overlay_layer = QgsRasterLayer(tmp_overlay, "overlapping")
@@ -331,8 +384,24 @@ class Worker(QObject):
                                                                 1, shader)
                     gsd_layer.setRenderer(renderer)
                     result.append(gsd_layer)
+            if raster_outputs:
+                # files of grid kept on disk are not needed any more
+                mosaic.close()
             # changing 'footprint' layer style
             if self.footprint_bool:
+                # achieved overlaps between neighbouring photos
+                strips = self.photo_strips()
+                if strips is not None:
+                    strips = strips[:footprint_lay.featureCount()]
+                with self.run_stats.stage('overlap_report'):
+                    overlaps = achieved_overlaps(footprint_lay, strips)
+                provider.changeAttributeValues(
+                    {fid: {i: None if v is None else round(v, 2)
+                           for i, v in enumerate(ovl)}
+                     for fid, ovl in overlaps.items()})
+                if strips is not None:
+                    result.append(self.strip_overlaps_layer(
+                        strip_overlaps(overlaps, strips)))
                 renderer = footprint_lay.renderer()
                 symbol = renderer.symbol()
                 prop = {'color': '255,0,0,30', 'color_border': '#000000',
@@ -343,46 +412,123 @@ class Worker(QObject):
                 result.append(footprint_lay)
             if self.killed is False:
                 self.progress.emit(100)
+            self.save_report(feat_count)
         except Exception as e:
             self.error.emit(e, traceback.format_exc())
             save_error()
         self.finished.emit(result)
         self.enabled.emit(True)
 
+    def save_checkpoint(self, checkpoint, done, new_footprints, mosaic):
+        """Save checkpoint of control run, warn and return False if it can
+        not be written (the run goes on without checkpoints)."""
+        try:
+            with self.run_stats.stage('checkpoint'):
+                checkpoint.save(done, new_footprints, mosaic)
+        except OSError as e:
+            self.run_stats.count('checkpoint_errors')
+            self.message.emit(f'Checkpoint can not be saved in '
+                              f'{checkpoint.directory} ({e}), the run '
+                              f'continues without checkpoints.')
+            return False
+        return True
+
+    def save_report(self, total):
+        """Emit final statistics of control run and save them as JSON
+        run report in the folder of the outputs."""
+        self.run_stats.counters['dtm_bytes_read'] = self.dtm_cache.bytes_read
+        done = self.run_stats.counters.get('photos_processed', 0)
+        self.stats.emit(self.run_stats.report(done, total))
+        self.report_path = os.path.join(QgsProcessingUtils.tempFolder(),
+                                        'run_report.json')
+        self.run_stats.save(self.report_path,
+                            workers=self.workers,
+                            chunk_size=self.chunk_size,
+                            dtm_cache=self.dtm_cache.stats(),
+                            stopped=self.killed)
+
+    def eo_parameters(self, transf_vct_rst):
+        """Return array of Exterior Orientation parameters
+        (X, Y, Z, omega, phi, kappa) of all projection centres,
+        Z is always above sea level."""
+        eo = []
+        for feature in self.layer.getFeatures():
+            Xs = feature.geometry().asPoint().x()
+            Ys = feature.geometry().asPoint().y()
+            Zs = feature.attribute(self.height_f)
+            omega = feature.attribute(self.omega_f)
+            phi = feature.attribute(self.phi_f)
+            kappa = feature.attribute(self.kappa_f)
+            eo.append([Xs, Ys, Zs, omega, phi, kappa])
+        eo = np.array(eo, dtype=float).reshape((-1, 6))
+        if not self.height_is_ASL:
+            eo[:, 2] += sample_heights(self.dtm_cache, eo[:, 0], eo[:, 1],
+                                       transf_vct_rst)
+        return eo
+
+    def photo_strips(self):
+        """Return list of strip numbers of all projection centres or None
+        if the layer has no numeric 'Strip' field."""
+        if self.layer.fields().indexOf('Strip') == -1:
+            return None
+        try:
+            return [int(f.attribute('Strip'))
+                    for f in self.layer.getFeatures()]
+        except (TypeError, ValueError):
+            return None
+
+    def strip_overlaps_layer(self, summary):
+        """Return table layer with achieved overlaps of every strip."""
+        strip_lay = QgsVectorLayer("None", "strip overlaps", "memory")
+        provider = strip_lay.dataProvider()
+        provider.addAttributes([QgsField("Strip", QVariant.Int),
+                                QgsField("Photos", QVariant.Int),
+                                QgsField("Forward min [%]", QVariant.Double),
+                                QgsField("Forward max [%]", QVariant.Double),
+                                QgsField("Sidelap min [%]", QVariant.Double),
+                                QgsField("Sidelap max [%]", QVariant.Double)])
+        strip_lay.updateFields()
+        feats = []
+        for strip, (photos, *ovl) in sorted(summary.items()):
+            feat = QgsFeature(strip_lay.fields())
+            feat.setAttributes([strip, photos] +
+                               [None if v is None else round(v, 2)
+                                for v in ovl])
+            feats.append(feat)
+        provider.addFeatures(feats)
+        return strip_lay
 
     def run_followingTerrain(self):
         result = []
         try:
-            if self.crs_rst != self.crs_vct:
-                transf_vct_rst = Transformer.from_crs(self.crs_vct,
-                                                      self.crs_rst,
-                                                      always_xy=True)
+            transf_vct_rst = get_transformer(self.crs_vct, self.crs_rst)
+            self.dtm_cache = DTMTileCache(self.raster, self.tile_size,
+                                          self.cache_size)
             feat_count = self.layer.featureCount()
             progress_c = 0
             step = feat_count // 1000
-            feats = self.layer.getFeatures()
-            for f in feats:
+            feats = list(self.layer.getFeatures())
+            # projection center coordinates
+            x = [f.geometry().asPoint().x() for f in feats]
+            y = [f.geometry().asPoint().y() for f in feats]
+            terrain_heights = sample_heights(self.dtm_cache, x, y,
+                                             transf_vct_rst)
+            # altitudes of all photos are written with one provider call
+            changes = {}
+            for f, terrain_height in zip(feats, terrain_heights):
                 if self.killed is True:
                     # kill request received, exit loop early
                     break
-                # projection center coordinates
-                x = f.geometry().asPoint().x()
-                y = f.geometry().asPoint().y()
-                if self.crs_rst != self.crs_vct:
-                    x, y = transf_coord(transf_vct_rst, x, y)
-
-                terrain_height, res = self.DTM.dataProvider().sample(QgsPointXY(x, y,), 1)
                 altitude_ASL = self.altitude_AGL + terrain_height
                 altitude_AGL = self.altitude_AGL
 
-                self.layer.startEditing()
-                self.layer.changeAttributeValue(f.id(), 4, round(altitude_ASL, 2))
-                self.layer.changeAttributeValue(f.id(), 5, round(altitude_AGL, 2))
-                self.layer.commitChanges()
+                changes[f.id()] = {4: round(altitude_ASL, 2),
+                                   5: round(altitude_AGL, 2)}
                 # increment progress
                 progress_c += 1
                 if step == 0 or progress_c % step == 0:
                     self.progress.emit(progress_c / float(feat_count) * 100)
+            self.layer.dataProvider().changeAttributeValues(changes)
             if self.killed is False:
                 self.progress.emit(100)
                 # deleting reduntant fields
@@ -416,35 +562,46 @@ class Worker(QObject):
         try:
             progress_c = 0
             step = self.s // 1000
-            feat_strip = QgsFeature()
 
-            if self.crs_rst != self.crs_vct:
-                transf_vct_rst = Transformer.from_crs(self.crs_vct,
-                                                      self.crs_rst,
-                                                      always_xy=True)
+            transf_vct_rst = get_transformer(self.crs_vct, self.crs_rst)
+            self.dtm_cache = DTMTileCache(self.raster, self.tile_size,
+                                          self.cache_size)
+            # index of projection centres by strip and by photo number,
+            # read from the layer once
+            strips = {}
+            photos = {}
+            for f in self.layer.getFeatures():
+                point = f.geometry().asPoint()
+                nr_p = int(f.attribute('Photo Number'))
+                strips.setdefault(int(f.attribute('Strip')), []).append(
+                    (nr_p, point.x(), point.y(),
+                     float(f.attribute('Kappa [deg]')),
+                     int(f.attribute('BuffNr')) if self.tab_widg_cor else None))
+                photos[nr_p] = (f.id(), point.x(), point.y())
+
+            # altitudes of all strips are written with one provider call
+            changes = {}
+            # common parts of strips and AoI (or buffers) and photos of strips
+            zones, strip_photos = [], []
             for t in range(1, self.s + 1):
 
                 if self.killed is True:
                     # kill request received, exit loop early
                     break
 
-                strip_nr = '%(StripNr)04d' % {'StripNr': t}
-                feats = self.layer.getFeatures('"Strip" = ' + str(strip_nr))
                 nrP_max = 0
                 nrP_min = 1000000
                 # finding first and last photo of strip
-                for f in feats:
-                    if int(f.attribute('Photo Number')) > nrP_max:
-                        nrP_max = int(f.attribute('Photo Number'))
-                        xg_max = f.geometry().asPoint().x()
-                        yg_max = f.geometry().asPoint().y()
-                    if int(f.attribute('Photo Number')) < nrP_min:
-                        nrP_min = int(f.attribute('Photo Number'))
-                        xg_min = f.geometry().asPoint().x()
-                        yg_min = f.geometry().asPoint().y()
-                    kappa = float(f.attribute('Kappa [deg]')) * pi / 180
+                for nr_p, xg, yg, kappa_deg, buff_nr in strips.get(t, []):
+                    if nr_p > nrP_max:
+                        nrP_max = nr_p
+                        xg_max, yg_max = xg, yg
+                    if nr_p < nrP_min:
+                        nrP_min = nr_p
+                        xg_min, yg_min = xg, yg
+                    kappa = kappa_deg * pi / 180
                     if self.tab_widg_cor:
-                        BuffNr = int(f.attribute('BuffNr'))
+                        BuffNr = buff_nr
 
                 # range of the strip
                 # ZLY ZASIEG!!!!!! (UCINA NIEWIELKA CZESC STRIP PRZEZ ZLE WIERZCHOLKI)
@@ -468,38 +625,41 @@ class Worker(QObject):
                 else:
                     common = g_strip.intersection(self.geom_aoi)
 
-                feat_strip.setGeometry(common)
-                common_lay = QgsVectorLayer("Polygon?crs=" + str(self.crs_vct),
-                                            "row", "memory")
-                prov_com = common_lay.dataProvider()
-                prov_com.addFeature(feat_strip)
+                zones.append(polygon_parts(common))
+
+                # photos of the strip
+                fids, x, y = [], [], []
+                for k in range(nrP_min, nrP_max + 1):
+                    if k in photos:
+                        ph_nr, x_pc, y_pc = photos[k]
+                    fids.append(ph_nr)
+                    x.append(x_pc)
+                    y.append(y_pc)
+                strip_photos.append((fids, x, y))
+
+            # terrain heights within all strips at once
+            heights = zonal_statistics(self.dtm_cache, zones, transf_vct_rst)
+            for (fids, x, y), (h_min, h_max) in zip(strip_photos, heights):
+
+                if self.killed is True:
+                    # kill request received, exit loop early
+                    break
 
-                h_min, h_max = minmaxheight(common_lay, self.DTM)
                 avg_terrain_height = h_max - (h_max - h_min) / 3
                 altitude_ASL = self.altitude_AGL + avg_terrain_height
+                terrain_heights = sample_heights(self.dtm_cache, x, y,
+                                                 transf_vct_rst)
 
                 # update altitude flight
-                self.layer.startEditing()
-                for k in range(nrP_min, nrP_max + 1):
-                    photo_nr = '%(Photo Number)05d' % {'Photo Number': k}
-                    ph_nr_iterator = self.layer.getFeatures('"Photo Number" = ' + str(photo_nr))
-                    for f in ph_nr_iterator:
-                        ph_nr = f.id()
-
-                    x = f.geometry().asPoint().x()
-                    y = f.geometry().asPoint().y()
-                    if self.crs_rst != self.crs_vct:
-                        x, y = transf_coord(transf_vct_rst, x, y)
-
-                    terrain_height, res = self.DTM.dataProvider().sample(QgsPointXY(x, y,), 1)
+                for ph_nr, terrain_height in zip(fids, terrain_heights):
                     altitude_AGL = altitude_ASL - terrain_height
-                    self.layer.changeAttributeValue(ph_nr, 5, round(altitude_AGL, 2))
-                    self.layer.changeAttributeValue(ph_nr, 4, round(altitude_ASL, 2))
-                self.layer.commitChanges()
+                    changes[ph_nr] = {5: round(altitude_AGL, 2),
+                                      4: round(altitude_ASL, 2)}
                 # increment progress
                 progress_c += 1
                 if step == 0 or progress_c % step == 0:
                     self.progress.emit(progress_c / self.s * 100)
+            self.layer.dataProvider().changeAttributeValues(changes)
             if self.killed is False:
                 self.progress.emit(100)
                 # deleting redundant fields